@@ -0,0 +1,1620 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from scipy import sparse, stats
+from scipy.spatial import cKDTree
+
+# ==========================================
+# ÍNDICE DAS COLUNAS CLIMÁTICAS
+# ==========================================
+PADRAO_COLUNA_CLIMATICA = re.compile(r'^(?P<atributo>.*)_dec(?P<decendio>\d+)_ano(?P<ano>\d+)')
+
+# Ciclo da soja usado no mapa de calor: Ano 1 (Dec 26-36) → Ano 2 (Dec 1-15)
+DECENDIOS_ANO1 = list(range(26, 37))
+DECENDIOS_ANO2 = list(range(1, 16))
+
+
+def indexar_colunas_climaticas(colunas):
+    """Índice (atributo, decêndio, ano safra) → posição das colunas climáticas.
+
+    Recebe todas as colunas do DataFrame carregado e interpreta os nomes
+    `<atributo>_decN_anoN` uma única vez. Além dos metadados, guarda a posição da
+    coluna (`Posição`), o rótulo usado nos gráficos e, para os decêndios do ciclo
+    da safra, o período e a ordem no mapa de calor.
+    """
+    colunas = pd.Index(colunas).astype(str)
+    partes = colunas.to_series(index=np.arange(len(colunas))).str.extract(PADRAO_COLUNA_CLIMATICA)
+    validas = partes['atributo'].notna().to_numpy()
+
+    partes = partes[validas]
+    decendio = partes['decendio'].astype(int).to_numpy()
+    ano_safra = ('ano' + partes['ano']).to_numpy()
+
+    indice = pd.DataFrame({
+        'Variável Climática': partes['atributo'].to_numpy(),
+        'Decêndio': decendio,
+        'Ano Safra': ano_safra,
+        'Coluna': colunas[validas].to_numpy(),
+        'Posição': np.flatnonzero(validas),
+    })
+    indice['Rótulo'] = (indice['Variável Climática'] + '_dec' + indice['Decêndio'].astype(str)
+                        + '_' + indice['Ano Safra'])
+
+    no_ano1 = (ano_safra == 'ano1') & np.isin(decendio, DECENDIOS_ANO1)
+    no_ano2 = (ano_safra == 'ano2') & np.isin(decendio, DECENDIOS_ANO2)
+    no_ciclo = no_ano1 | no_ano2
+    indice['Período'] = (np.where(no_ano1, 'Ano1_Dec', 'Ano2_Dec')
+                         + indice['Decêndio'].astype(str)).where(no_ciclo)
+    indice['Decêndio_Order'] = np.where(
+        no_ano1, decendio - DECENDIOS_ANO1[0],
+        np.where(no_ano2, len(DECENDIOS_ANO1) + decendio - DECENDIOS_ANO2[0], -1)
+    )
+    return indice
+
+
+# ==========================================
+# PREPARAÇÃO E CACHE COLUNAR DOS DADOS
+# ==========================================
+# Incrementar sempre que `preparar_dados` mudar, para invalidar caches antigos
+VERSAO_CACHE = 3
+
+# Tamanho aproximado (valores × 8 bytes) de cada bloco lido do CSV na ingestão;
+# é o que limita o pico de memória da carga, qualquer que seja o tamanho do arquivo
+BYTES_POR_BLOCO = 64 * 2 ** 20
+
+# Cache usado quando não há permissão de escrita ao lado do CSV
+PASTA_CACHE_TEMPORARIA = os.path.join(tempfile.gettempdir(), 'dashboard_soja_cache')
+
+
+def preparar_dados(df):
+    """Aplica ao CSV bruto da PAM/NASA POWER as colunas derivadas e conversões do dashboard.
+
+    Só usa operações linha a linha, então vale tanto para o arquivo inteiro quanto
+    para cada bloco da ingestão. Medidas numéricas ficam em float64 (clima em
+    float32) para que todos os blocos tenham o mesmo esquema.
+    """
+    # Calcular área perdida
+    df['Área perdida (Hectares)'] = df['Área plantada (Hectares)'] - df['Área colhida (Hectares)']
+    df['Percentual de perda (%)'] = (df['Área perdida (Hectares)'] / df['Área plantada (Hectares)']) * 100
+    
+    # Converter valores de mil para valores reais
+    df['Quantidade produzida (Toneladas)'] = df['Quantidade produzida (Toneladas)'] * 1000
+    df['Valor da produção (Mil Reais)'] = df['Valor da produção (Mil Reais)'] * 1000
+    
+    # Renomear coluna para merge
+    df = df.rename(columns={'Código IBGE': 'codigo_ibge'})
+    df['codigo_ibge'] = df['codigo_ibge'].astype(str).str.zfill(7).str[:7].astype(int)
+    
+    # Tipos compactos e estáveis entre blocos: clima em float32, demais medidas em float64
+    colunas_clima = indexar_colunas_climaticas(df.columns)['Coluna']
+    df[colunas_clima] = df[colunas_clima].astype(np.float32)
+    for coluna in df.columns.difference(colunas_clima):
+        if coluna not in ('ano', 'codigo_ibge') and df[coluna].dtype.kind in 'iub':
+            df[coluna] = df[coluna].astype(np.float64)
+    
+    return df
+
+
+def _hash_arquivo(caminho, bloco=1 << 20):
+    """SHA-256 do arquivo, lido em blocos."""
+    h = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for parte in iter(lambda: f.read(bloco), b''):
+            h.update(parte)
+    return h.hexdigest()
+
+
+def _selecao_colunas(cabecalho, atributos=None, apenas_ciclo=False):
+    """Colunas a ler do CSV (na ordem do arquivo) e as climáticas entre elas.
+
+    Colunas não climáticas são sempre lidas; das climáticas, só as dos
+    `atributos` pedidos e, com `apenas_ciclo`, só os decêndios do ciclo da soja.
+    """
+    indice = indexar_colunas_climaticas(cabecalho)
+    manter = np.ones(len(indice), dtype=bool)
+    if atributos is not None:
+        manter &= indice['Variável Climática'].isin(list(atributos)).to_numpy()
+    if apenas_ciclo:
+        manter &= (indice['Decêndio_Order'] >= 0).to_numpy()
+    
+    climaticas = set(indice['Coluna'])
+    selecionadas = set(indice.loc[manter, 'Coluna'])
+    usadas = [col for col in cabecalho if col not in climaticas or col in selecionadas]
+    return usadas, [col for col in usadas if col in selecionadas]
+
+
+def _tipos_nao_climaticos(caminho_csv, usadas, climaticas):
+    """dtype de cada coluna não climática, inferido sobre o arquivo inteiro.
+
+    A inferência por bloco do `read_csv` depende do conteúdo do bloco (texto
+    vazio vira float64, inteiro com NaN vira float64), e o esquema do cache é
+    fixado no primeiro bloco. Uma leitura só das colunas não climáticas,
+    estreita, dá os tipos de todos os blocos; texto fica como object.
+    """
+    climaticas = set(climaticas)
+    nao_climaticas = [col for col in usadas if col not in climaticas]
+    tipos = pd.read_csv(caminho_csv, usecols=nao_climaticas).dtypes
+    return {col: (object if tipo == object else tipo) for col, tipo in tipos.items()}
+
+
+def _gravar_cache_em_blocos(caminho_csv, caminho_cache, usadas, climaticas, codigos_uf, linhas_por_bloco):
+    """Lê o CSV em blocos, prepara cada um e acrescenta ao arquivo Feather (Arrow IPC).
+
+    Só um bloco por vez fica em memória. Os tipos das colunas não climáticas
+    vêm de `_tipos_nao_climaticos`, então todos os blocos têm o mesmo esquema.
+    O arquivo é escrito num temporário e renomeado ao final, para que uma
+    carga interrompida não deixe cache parcial.
+    """
+    temporario = f"{caminho_cache}.{os.getpid()}.tmp"
+    escritor = None
+    try:
+        tipos = _tipos_nao_climaticos(caminho_csv, usadas, climaticas)
+        tipos.update({col: np.float32 for col in climaticas})
+        leitor = pd.read_csv(caminho_csv, usecols=usadas, chunksize=linhas_por_bloco, dtype=tipos)
+        for bloco in leitor:
+            bloco = preparar_dados(bloco)
+            if codigos_uf is not None:
+                bloco = bloco[np.isin(bloco['codigo_ibge'].to_numpy() // 100000, list(codigos_uf))]
+            
+            if escritor is None:
+                esquema = pa.Schema.from_pandas(bloco, preserve_index=False)
+                # Coluna de texto (object) toda nula no primeiro bloco: fixa como string
+                for i, campo in enumerate(esquema):
+                    if pa.types.is_null(campo.type):
+                        esquema = esquema.set(i, campo.with_type(pa.string()))
+                escritor = pa.ipc.new_file(temporario, esquema)
+            escritor.write_table(pa.Table.from_pandas(bloco, schema=esquema, preserve_index=False))
+        escritor.close()
+        escritor = None
+        os.replace(temporario, caminho_cache)
+    finally:
+        if escritor is not None:
+            escritor.close()
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+
+def _ler_cache(caminho_cache, colunas=None):
+    """DataFrame do cache Feather, com `Município` como categoria em ordem alfabética."""
+    df = feather.read_table(caminho_cache, columns=colunas, memory_map=True).to_pandas(categories=['Município'])
+    # O dicionário do Arrow segue a ordem de aparição; os groupbys contam com a ordem alfabética
+    if 'Município' in df.columns:
+        df['Município'] = df['Município'].cat.reorder_categories(df['Município'].cat.categories.sort_values())
+    return df
+
+
+def garantir_cache(caminho_csv, pasta_cache='.cache_dados', atributos=None,
+                   apenas_ciclo=False, codigos_uf=None, linhas_por_bloco=None):
+    """Caminho do cache Feather (Arrow) do CSV preparado, ingerindo o CSV se preciso.
+
+    O CSV é ingerido em blocos de `linhas_por_bloco` linhas (por padrão, o que
+    cabe em `BYTES_POR_BLOCO` para a largura do arquivo), cada um preparado e
+    acrescentado ao cache, então o pico de memória da ingestão não depende do
+    tamanho do arquivo. `atributos` (nomes das variáveis climáticas),
+    `apenas_ciclo` (só os decêndios do ciclo da soja) e `codigos_uf` (UFs pelo
+    prefixo do código IBGE) restringem o que é lido; cada seleção tem seu cache.
+    
+    O cache é válido enquanto mtime/tamanho do CSV não mudarem; se mudarem, o
+    SHA-256 do conteúdo decide se ainda vale. Sem permissão de escrita ao lado do
+    CSV, o cache vai para uma pasta no diretório temporário do sistema.
+    """
+    info = os.stat(caminho_csv)
+    pasta = os.path.join(os.path.dirname(os.path.abspath(caminho_csv)), pasta_cache)
+    nome = os.path.splitext(os.path.basename(caminho_csv))[0]
+    
+    selecao = {
+        'atributos': sorted(atributos) if atributos is not None else None,
+        'apenas_ciclo': bool(apenas_ciclo),
+        'codigos_uf': sorted(int(uf) for uf in codigos_uf) if codigos_uf is not None else None,
+    }
+    if any(selecao.values()):
+        nome += '-' + hashlib.blake2b(json.dumps(selecao).encode('utf-8'), digest_size=6).hexdigest()
+    caminho_cache = os.path.join(pasta, f"{nome}.feather")
+    caminho_meta = os.path.join(pasta, f"{nome}.json")
+    
+    chave = {'versao': VERSAO_CACHE, 'mtime_ns': info.st_mtime_ns, 'tamanho': info.st_size}
+    
+    meta = None
+    if os.path.exists(caminho_cache) and os.path.exists(caminho_meta):
+        try:
+            with open(caminho_meta, encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+    
+    if meta is not None and meta.get('versao') == VERSAO_CACHE and meta.get('selecao') == selecao:
+        valido = meta.get('mtime_ns') == chave['mtime_ns'] and meta.get('tamanho') == chave['tamanho']
+        if not valido and meta.get('sha256') == _hash_arquivo(caminho_csv):
+            # Arquivo tocado mas com o mesmo conteúdo: só atualiza a chave
+            meta.update(chave)
+            _gravar_meta(caminho_meta, meta)
+            valido = True
+        if valido:
+            return caminho_cache
+    
+    cabecalho = pd.read_csv(caminho_csv, nrows=0).columns
+    usadas, climaticas = _selecao_colunas(cabecalho, atributos, apenas_ciclo)
+    if linhas_por_bloco is None:
+        linhas_por_bloco = max(1000, BYTES_POR_BLOCO // (8 * len(usadas)))
+    
+    try:
+        os.makedirs(pasta, exist_ok=True)
+        _gravar_cache_em_blocos(caminho_csv, caminho_cache, usadas, climaticas, codigos_uf, linhas_por_bloco)
+        _gravar_meta(caminho_meta, {**chave, 'selecao': selecao, 'sha256': _hash_arquivo(caminho_csv)})
+    except OSError:
+        if pasta == PASTA_CACHE_TEMPORARIA:
+            raise
+        return garantir_cache(caminho_csv, PASTA_CACHE_TEMPORARIA, atributos, apenas_ciclo,
+                              codigos_uf, linhas_por_bloco)
+    
+    return caminho_cache
+
+
+def carregar_dados_preparados(caminho_csv, pasta_cache='.cache_dados', **selecao):
+    """Carrega o CSV já preparado, inteiro, a partir do cache Feather (ver `garantir_cache`).
+
+    Com cache válido, a carga é só uma leitura mapeada em memória do arquivo
+    Feather, sem parse do CSV. Para carregar as colunas climáticas sob demanda,
+    use `abrir_dados_sob_demanda`.
+    """
+    return _ler_cache(garantir_cache(caminho_csv, pasta_cache, **selecao))
+
+
+def _gravar_meta(caminho_meta, meta):
+    with open(caminho_meta, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+
+# ==========================================
+# COLUNAS CLIMÁTICAS SOB DEMANDA
+# ==========================================
+# Atributos climáticos (blocos de colunas) mantidos em memória por processo
+MAX_BLOCOS_CLIMATICOS = 8
+
+
+class ColunasClimaticas:
+    """Colunas climáticas do cache Feather, lidas por atributo no primeiro acesso.
+
+    Um bloco é o conjunto de colunas `<atributo>_decN_anoN` de um atributo, em
+    float32, na ordem do índice. Os blocos lidos ficam num LRU de até
+    `max_blocos` atributos; o menos usado recentemente sai quando outro entra.
+    Assim a memória fica proporcional aos atributos de fato explorados, e não à
+    largura do arquivo. Pode ser compartilhado entre sessões (acesso com lock).
+    """
+
+    def __init__(self, caminho_cache, indice, max_blocos=MAX_BLOCOS_CLIMATICOS):
+        self.caminho_cache = caminho_cache
+        self.indice = indice
+        self.max_blocos = max_blocos
+        self.leituras = 0
+        self._blocos = OrderedDict()
+        self._colunas_por_atributo = indice.groupby('Variável Climática', sort=False)['Coluna'].agg(list).to_dict()
+        self._atributo_da_coluna = dict(zip(indice['Coluna'], indice['Variável Climática']))
+        self._lock = threading.Lock()
+
+    def bloco(self, atributo, reter=True):
+        """DataFrame (float32) com todas as colunas do atributo.
+
+        Com `reter=False` (leituras em lote, que passam por todos os atributos),
+        um bloco que não está em memória é lido do cache Feather sem entrar no
+        LRU nem tirar de lá os atributos que o usuário está explorando.
+        """
+        with self._lock:
+            if atributo in self._blocos:
+                if reter:
+                    self._blocos.move_to_end(atributo)
+                return self._blocos[atributo]
+        
+        colunas = self._colunas_por_atributo[atributo]
+        bloco = feather.read_table(self.caminho_cache, columns=colunas, memory_map=True).to_pandas()
+        
+        with self._lock:
+            self.leituras += 1
+            if not reter:
+                return bloco
+            self._blocos[atributo] = bloco
+            self._blocos.move_to_end(atributo)
+            while len(self._blocos) > self.max_blocos:
+                self._blocos.popitem(last=False)
+        return bloco
+
+    def coluna(self, nome):
+        """Valores (float32) de uma coluna climática, carregando o bloco do seu atributo."""
+        return self.bloco(self._atributo_da_coluna[nome])[nome].to_numpy()
+
+    def residentes(self):
+        """Atributos em memória, do menos ao mais usado recentemente."""
+        with self._lock:
+            return list(self._blocos)
+
+
+def abrir_dados_sob_demanda(caminho_csv, pasta_cache='.cache_dados',
+                            max_blocos=MAX_BLOCOS_CLIMATICOS, **selecao):
+    """Colunas de produção já carregadas + `ColunasClimaticas` para o clima, sob demanda.
+
+    Devolve `(df, indice, clima)`: `df` tem só as colunas não climáticas, `indice`
+    é o `indexar_colunas_climaticas` do arquivo completo e `clima` lê os
+    atributos do cache Feather conforme são usados.
+    """
+    caminho_cache = garantir_cache(caminho_csv, pasta_cache, **selecao)
+    with pa.memory_map(caminho_cache) as fonte:
+        nomes = pa.ipc.open_file(fonte).schema.names
+    indice = indexar_colunas_climaticas(nomes)
+    climaticas = set(indice['Coluna'])
+    df = _ler_cache(caminho_cache, [col for col in nomes if col not in climaticas])
+    return df, indice, ColunasClimaticas(caminho_cache, indice, max_blocos)
+
+
+# ==========================================
+# MUNICÍPIOS (COORDENADAS)
+# ==========================================
+CODIGO_UF_PARANA = 41
+
+# Raio médio da Terra, para as distâncias entre municípios
+RAIO_TERRA_KM = 6371.0088
+
+
+def preparar_municipios(df_municipios, codigo_uf=CODIGO_UF_PARANA):
+    """Municípios de uma UF com `lon`/`lat` e código IBGE de 7 dígitos, prontos para o merge.
+
+    Com `codigo_uf` None, mantém os municípios de todas as UFs.
+    """
+    if codigo_uf is None:
+        df_uf = df_municipios.copy()
+    else:
+        df_uf = df_municipios[df_municipios['codigo_uf'] == codigo_uf].copy()
+    df_uf = df_uf.rename(columns={'longitude': 'lon', 'latitude': 'lat'})
+    df_uf['codigo_ibge'] = df_uf['codigo_ibge'].astype(str).str.zfill(7).str[:7].astype(int)
+    return df_uf
+
+
+def _vetores_unitarios(lat, lon):
+    """Pontos (n × 3) na esfera unitária; a corda entre dois pontos é monotônica na distância."""
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+class IndiceEspacial:
+    """KD-tree sobre as coordenadas dos municípios (tabela de `preparar_municipios`).
+
+    As coordenadas são convertidas para a esfera unitária, de modo que a busca
+    por raio usa a distância de grande círculo exata, sem a distorção de
+    tratar lat/lon como um plano. As consultas por caixa (viewport) usam a
+    latitude ordenada com busca binária. Todas devolvem linhas da tabela de
+    municípios, sem varrer a tabela inteira.
+    """
+
+    def __init__(self, municipios):
+        self.municipios = municipios.reset_index(drop=True)
+        lat = self.municipios['lat'].to_numpy(dtype=np.float64)
+        self._arvore = cKDTree(_vetores_unitarios(lat, self.municipios['lon'].to_numpy(dtype=np.float64)))
+        self._ordem_lat = np.argsort(lat, kind='stable')
+        self._lat_ordenada = lat[self._ordem_lat]
+        self._lat = lat
+        self._lon = self.municipios['lon'].to_numpy(dtype=np.float64)
+        self._codigos = pd.Index(self.municipios['codigo_ibge'])
+
+    def __len__(self):
+        return len(self.municipios)
+
+    def _com_distancias(self, posicoes, lat, lon):
+        """Linhas em `posicoes` com a coluna 'distancia_km' até (lat, lon), da mais próxima à mais distante."""
+        posicoes = np.asarray(posicoes, dtype=np.int64)
+        corda = np.linalg.norm(self._arvore.data[posicoes] - _vetores_unitarios([lat], [lon]), axis=1)
+        distancias = 2 * RAIO_TERRA_KM * np.arcsin(np.clip(corda / 2, 0, 1))
+        ordem = np.argsort(distancias, kind='stable')
+        resultado = self.municipios.iloc[posicoes[ordem]].copy()
+        resultado['distancia_km'] = distancias[ordem]
+        return resultado
+
+    def no_raio(self, lat, lon, raio_km):
+        """Municípios a até `raio_km` de (lat, lon), com 'distancia_km', do mais próximo ao mais distante."""
+        angulo = min(raio_km / RAIO_TERRA_KM, np.pi)
+        posicoes = self._arvore.query_ball_point(_vetores_unitarios([lat], [lon])[0], 2 * np.sin(angulo / 2))
+        return self._com_distancias(posicoes, lat, lon)
+
+    def na_caixa(self, lat_min, lat_max, lon_min, lon_max):
+        """Municípios dentro da caixa (limites inclusivos), na ordem da tabela."""
+        inicio = np.searchsorted(self._lat_ordenada, lat_min, side='left')
+        fim = np.searchsorted(self._lat_ordenada, lat_max, side='right')
+        candidatos = self._ordem_lat[inicio:fim]
+        lon = self._lon[candidatos]
+        posicoes = np.sort(candidatos[(lon >= lon_min) & (lon <= lon_max)])
+        return self.municipios.iloc[posicoes]
+
+    def mais_proximos(self, lat, lon, k=1):
+        """Os `k` municípios mais próximos de (lat, lon), com 'distancia_km'."""
+        k = min(k, len(self))
+        if k == 0:
+            return self._com_distancias([], lat, lon)
+        _, posicoes = self._arvore.query(_vetores_unitarios([lat], [lon])[0], k=[i + 1 for i in range(k)])
+        return self._com_distancias(posicoes, lat, lon)
+
+    def vizinhos_do_municipio(self, codigo_ibge, raio_km):
+        """Municípios a até `raio_km` do município `codigo_ibge` (ele incluso, a 0 km)."""
+        posicao = self._codigos.get_loc(codigo_ibge)
+        return self.no_raio(self._lat[posicao], self._lon[posicao], raio_km)
+
+    def adjacencia(self, codigos, k=None, raio_km=None):
+        """Matriz esparsa (CSR, 0/1) de vizinhança entre os municípios `codigos`.
+
+        Cada município é vizinho de si mesmo e dos seus `k` vizinhos mais
+        próximos, ou de todos a até `raio_km`, considerando só os `codigos`
+        (a vizinhança não atravessa municípios ausentes da base). Códigos sem
+        coordenadas ficam só consigo mesmos.
+        """
+        if (k is None) == (raio_km is None):
+            raise ValueError("Informe exatamente um entre `k` e `raio_km`.")
+
+        n = len(codigos)
+        posicoes = self._codigos.get_indexer(np.asarray(codigos))
+        conhecidos = np.flatnonzero(posicoes >= 0)
+        pontos = self._arvore.data[posicoes[conhecidos]]
+        if len(conhecidos) == 0:
+            origem = destino = np.zeros(0, dtype=np.int64)
+        elif k is not None:
+            # O próprio município vem na primeira posição (distância zero)
+            vizinhos = min(k + 1, len(conhecidos))
+            _, destino = cKDTree(pontos).query(pontos, k=[i + 1 for i in range(vizinhos)])
+            origem = np.repeat(np.arange(len(conhecidos)), vizinhos)
+            destino = destino.ravel()
+        else:
+            angulo = min(raio_km / RAIO_TERRA_KM, np.pi)
+            arvore = cKDTree(pontos)
+            pares = arvore.sparse_distance_matrix(arvore, 2 * np.sin(angulo / 2), output_type='ndarray')
+            origem, destino = pares['i'], pares['j']
+
+        adjacencia = sparse.coo_matrix(
+            (np.ones(len(origem)), (conhecidos[origem], conhecidos[destino])), shape=(n, n)
+        ) + sparse.identity(n, format='coo')
+        adjacencia = adjacencia.tocsr()
+        adjacencia.data[:] = 1.0
+        return adjacencia
+
+
+def matriz_vizinhanca(df, indice_espacial, linhas=None, k=None, raio_km=None):
+    """Matriz esparsa (linhas do recorte × linhas do recorte) da vizinhança espacial.
+
+    Liga cada linha município-ano às linhas dos municípios vizinhos (ver
+    `IndiceEspacial.adjacencia`) no mesmo ano. É montada só com produtos
+    esparsos: a adjacência entre municípios é replicada por ano (`kron`) e
+    projetada nas linhas. Use-a como `vizinhanca=` nas correlações para
+    suavizar métricas e clima pela média da vizinhança.
+    """
+    codigos = df['codigo_ibge'].to_numpy() if linhas is None else df.loc[linhas, 'codigo_ibge'].to_numpy()
+    anos = df['ano'].to_numpy() if linhas is None else df.loc[linhas, 'ano'].to_numpy()
+    codigos_unicos, municipio = np.unique(codigos, return_inverse=True)
+    anos_unicos, ano = np.unique(anos, return_inverse=True)
+
+    adjacencia = indice_espacial.adjacencia(codigos_unicos, k=k, raio_km=raio_km)
+    por_ano = sparse.kron(sparse.identity(len(anos_unicos), format='csr'), adjacencia, format='csr')
+    # Projeção linha → (ano, município)
+    celula = ano * len(codigos_unicos) + municipio
+    projecao = sparse.csr_matrix(
+        (np.ones(len(celula)), (np.arange(len(celula)), celula)), shape=(len(celula), por_ano.shape[0])
+    )
+    return (projecao @ por_ano @ projecao.T).tocsr()
+
+
+def media_na_vizinhanca(vizinhanca, X):
+    """Média de cada coluna de `X` na vizinhança de cada linha, ignorando NaN.
+
+    Duas multiplicações esparsas (somas e contagens de valores válidos) para a
+    matriz inteira; linhas sem nenhum vizinho válido ficam NaN.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    validos = ~np.isnan(X)
+    somas = vizinhanca @ np.where(validos, X, 0.0)
+    contagens = vizinhanca @ validos.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(contagens > 0, somas / contagens, np.nan)
+
+
+# ==========================================
+# RECORTE E INDICADORES
+# ==========================================
+def mascara_recorte(df, anos, municipios, ano=None):
+    """Máscara booleana (NumPy) das linhas no recorte de anos e municípios.
+
+    Com `ano`, restringe também a um único ano (mapa e análises por ano).
+    """
+    mascara = (df['ano'].isin(anos) & df['Município'].isin(municipios)).to_numpy()
+    if ano is not None:
+        mascara = mascara & (df['ano'] == ano).to_numpy()
+    return mascara
+
+
+def variacoes_ultimo_ano(df_agregado):
+    """Último ano agregado e a variação de cada indicador frente ao ano anterior.
+
+    Variações em % (0 quando o valor anterior não é positivo); para o percentual
+    de perda, a diferença em pontos percentuais. Com um único ano, compara o ano
+    com ele mesmo.
+    """
+    ultimo = df_agregado.iloc[-1]
+    anterior = df_agregado.iloc[-2] if len(df_agregado) > 1 else ultimo
+    
+    variacoes = {}
+    for medida in ['Área plantada (Hectares)', 'Área perdida (Hectares)',
+                   'Quantidade produzida (Toneladas)',
+                   'Rendimento médio da produção (Quilogramas por Hectare)']:
+        if anterior[medida] > 0:
+            variacoes[medida] = (ultimo[medida] - anterior[medida]) / anterior[medida] * 100
+        else:
+            variacoes[medida] = 0
+    variacoes['Percentual de perda (%)'] = ultimo['Percentual de perda (%)'] - anterior['Percentual de perda (%)']
+    return ultimo, variacoes
+
+
+# ==========================================
+# MOTOR DE CORRELAÇÃO VETORIZADO
+# ==========================================
+# Variáveis de soja da análise climática automática
+VARIAVEIS_SOJA = [
+    'Rendimento médio da produção (Quilogramas por Hectare)',
+    'Quantidade produzida (Toneladas)',
+    'Área perdida (Hectares)',
+    'Percentual de perda (%)'
+]
+
+# Opções de foco da análise climática
+METRICAS_FOCO = VARIAVEIS_SOJA + ['Valor da produção (Mil Reais)']
+
+# Métodos de correlação da análise climática
+METODOS_CORRELACAO = {
+    'pearson': 'Pearson',
+    # Postos do recorte antes da exclusão de pares incompletos: com dados
+    # faltantes, difere um pouco do Spearman calculado só nos pares completos
+    'spearman': 'Postos (≈ Spearman)',
+    'parcial': 'Parcial (controlando o ano)',
+}
+
+# Variáveis da matriz de correlação de produção
+COLUNAS_CORRELACAO_PRODUCAO = [
+    'Área plantada (Hectares)',
+    'Área colhida (Hectares)',
+    'Área perdida (Hectares)',
+    'Quantidade produzida (Toneladas)',
+    'Rendimento médio da produção (Quilogramas por Hectare)',
+    'Valor da produção (Mil Reais)',
+    'Valor da produção - percentual do total geral',
+    'Percentual de perda (%)'
+]
+
+
+def _matriz(df, colunas, linhas=None):
+    """Extrai as colunas como matriz float64 (NaN preservado).
+
+    `linhas` (máscara booleana ou posições) restringe as linhas sem copiar o
+    DataFrame inteiro: só as colunas pedidas são materializadas.
+    """
+    dados = df[list(colunas)] if linhas is None else df.loc[linhas, list(colunas)]
+    return dados.to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def _matriz_climatica(df, indice, linhas=None):
+    """Extrai as colunas climáticas do índice por posição, sem busca por nome."""
+    posicoes = indice['Posição'].to_numpy()
+    dados = df.iloc[:, posicoes] if linhas is None else df.iloc[linhas, posicoes]
+    return dados.to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def _blocos_climaticos(df, indice, linhas, clima):
+    """(posições no índice, matriz float64) de cada atributo climático, um de cada vez.
+
+    O bloco de um atributo é a unidade do cálculo, tanto em série quanto em
+    paralelo; com `clima`, ele vem do armazém de colunas sob demanda, sem
+    ficar retido no LRU (os cálculos em lote passam por todos os atributos).
+    """
+    colunas = indice['Coluna'].to_numpy()
+    # Sem `clima`, a matriz inteira sai de uma vez (uma só extração do DataFrame)
+    matriz = _matriz_climatica(df, indice, linhas) if clima is None else None
+    for atributo, posicoes in indice.groupby('Variável Climática', sort=False).indices.items():
+        if clima is None:
+            yield posicoes, matriz[:, posicoes]
+        else:
+            yield posicoes, _matriz(clima.bloco(atributo, reter=False), colunas[posicoes], linhas)
+
+
+def _preparar_grupos(Y, anos, grupos, metodo):
+    """Métricas (ou seus postos) e ano de controle de cada grupo: {chave: (seleção, Y, z)}."""
+    por_grupo = {}
+    for chave, selecao in grupos.items():
+        Y_grupo = np.ascontiguousarray(Y[selecao])
+        if metodo == 'spearman':
+            Y_grupo = postos(Y_grupo)
+        por_grupo[chave] = (selecao, Y_grupo, anos[selecao] if anos is not None else None)
+    return por_grupo
+
+
+def _correlacionar_bloco(X, por_grupo, min_amostras, metodo):
+    """Correlações de um bloco de colunas climáticas com as métricas de cada grupo.
+
+    As linhas de cada grupo são copiadas para um array contíguo antes do
+    cálculo: com entradas de mesmo valor e mesmo layout, o resultado é o mesmo
+    bit a bit em qualquer processo. Devolve {chave: (corr, n, controles)},
+    com `controles` o número de variáveis de fato controladas em cada par.
+    """
+    resultado = {}
+    for chave, (selecao, Y, z) in por_grupo.items():
+        X_grupo = np.ascontiguousarray(X[selecao])
+        if metodo == 'parcial':
+            corr, n, controlado = correlacao_parcial_pareada(X_grupo, Y, z, min_amostras, devolver_controle=True)
+            resultado[chave] = (corr, n, controlado.astype(np.int64))
+            continue
+        if metodo == 'spearman':
+            corr, n = correlacao_pareada(postos(X_grupo), Y, min_amostras)
+        else:
+            corr, n = correlacao_pareada(X_grupo, Y, min_amostras)
+        resultado[chave] = (corr, n, np.zeros_like(n))
+    return resultado
+
+
+def _suavizar(vizinhanca, X):
+    """`media_na_vizinhanca`, ou `X` intacto sem vizinhança."""
+    return X if vizinhanca is None else media_na_vizinhanca(vizinhanca, X)
+
+
+def _correlacoes_por_grupo(df, indice, metricas, min_amostras, linhas, clima, metodo, grupos, executor=None,
+                           vizinhanca=None):
+    """Correlações (colunas do índice × métricas) em cada grupo de linhas do recorte.
+
+    `grupos` mapeia uma chave a um seletor de linhas (máscara ou fatia) sobre as
+    linhas do recorte `linhas`. Cada bloco de colunas climáticas (um atributo)
+    é extraído uma única vez e correlacionado com todos os grupos. Com
+    `executor` (de `criar_pool_correlacoes`), os blocos são distribuídos entre
+    processos, com o mesmo resultado. Com `vizinhanca` (`matriz_vizinhanca` do
+    mesmo recorte), métricas e blocos são trocados pela média da vizinhança
+    antes de correlacionar. Devolve {chave: (correlações, n por par,
+    controles por par)}; `controles` é 1 só nos pares da correlação parcial em
+    que o ano variou.
+    """
+    if metodo not in METODOS_CORRELACAO:
+        raise ValueError(f"Método de correlação desconhecido: {metodo!r}")
+
+    Y = _matriz(df, metricas, linhas)
+    if vizinhanca is not None:
+        if vizinhanca.shape != (len(Y), len(Y)):
+            raise ValueError("A matriz de vizinhança não corresponde às linhas do recorte.")
+        Y = media_na_vizinhanca(vizinhanca, Y)
+    anos = _matriz(df, ['ano'], linhas)[:, 0] if metodo == 'parcial' else None
+    if executor is not None:
+        blocos = _correlacoes_em_paralelo(executor, df, indice, Y, anos, grupos, linhas, clima,
+                                          min_amostras, metodo, vizinhanca)
+    else:
+        # Métricas, postos e ano de controle por grupo: uma vez, valem para todos os blocos
+        por_grupo = _preparar_grupos(Y, anos, grupos, metodo)
+        blocos = ((posicoes, _correlacionar_bloco(_suavizar(vizinhanca, X), por_grupo, min_amostras, metodo))
+                  for posicoes, X in _blocos_climaticos(df, indice, linhas, clima))
+    
+    resultado = {
+        chave: (np.full((len(indice), len(metricas)), np.nan),
+                np.zeros((len(indice), len(metricas)), dtype=np.int64),
+                np.zeros((len(indice), len(metricas)), dtype=np.int64))
+        for chave in grupos
+    }
+    for posicoes, por_chave in blocos:
+        for chave, parciais in por_chave.items():
+            for destino, valores in zip(resultado[chave], parciais):
+                destino[posicoes] = valores
+    return resultado
+
+
+def _correlacoes_climaticas(df, indice, metricas, min_amostras, linhas, clima, metodo='pearson', executor=None,
+                            vizinhanca=None):
+    """Correlações (colunas do índice × métricas), lendo o clima de `df` ou de `clima`.
+
+    Devolve (correlações, n por par, controles por par). Com `clima`
+    (`ColunasClimaticas`), cada atributo é correlacionado a partir do seu bloco,
+    um de cada vez; o resultado é o mesmo, pois cada par de colunas é
+    independente dos demais. `metodo` é uma das chaves de `METODOS_CORRELACAO`.
+    """
+    grupos = {None: slice(None)}
+    return _correlacoes_por_grupo(df, indice, metricas, min_amostras, linhas, clima, metodo, grupos,
+                                  executor, vizinhanca)[None]
+
+
+def _n_linhas(df, linhas):
+    if linhas is None:
+        return len(df)
+    linhas = np.asarray(linhas)
+    return int(linhas.sum()) if linhas.dtype == bool else len(linhas)
+
+
+def correlacao_pareada(X, Y, min_amostras=1):
+    """Correlação de Pearson entre cada coluna de X e cada coluna de Y.
+
+    Usa apenas as linhas em que os dois valores do par existem (pairwise-complete),
+    como `DataFrame.corr()`, mas calcula todos os pares em uma única passada de
+    produtos matriciais mascarados. Retorna (correlações, n por par); pares com
+    menos de `min_amostras` observações ou variância nula ficam como NaN.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+
+    mx = ~np.isnan(X)
+    my = ~np.isnan(Y)
+
+    # Centralizar pelas médias globais reduz o cancelamento numérico nas somas
+    X = np.where(mx, X, 0.0)
+    Y = np.where(my, Y, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        media_x = np.nan_to_num(X.sum(axis=0) / mx.sum(axis=0))
+        media_y = np.nan_to_num(Y.sum(axis=0) / my.sum(axis=0))
+    X = np.where(mx, X - media_x, 0.0)
+    Y = np.where(my, Y - media_y, 0.0)
+
+    mxf = mx.astype(np.float64)
+    myf = my.astype(np.float64)
+
+    n = mxf.T @ myf
+    soma_x = X.T @ myf
+    soma_y = mxf.T @ Y
+    soma_xx = (X * X).T @ myf
+    soma_yy = mxf.T @ (Y * Y)
+    soma_xy = X.T @ Y
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = soma_xy - soma_x * soma_y / n
+        var_x = soma_xx - soma_x * soma_x / n
+        var_y = soma_yy - soma_y * soma_y / n
+        # Variâncias residuais de arredondamento equivalem a colunas constantes
+        var_x = np.where(var_x > soma_xx * 1e-12, var_x, np.nan)
+        var_y = np.where(var_y > soma_yy * 1e-12, var_y, np.nan)
+        corr = np.clip(cov / np.sqrt(var_x * var_y), -1.0, 1.0)
+
+    n = n.astype(np.int64)
+    corr[n < max(min_amostras, 2)] = np.nan
+    return corr, n
+
+
+def postos(M):
+    """Postos de cada coluna de M (empates recebem o posto médio; NaN continua NaN).
+
+    Todas as colunas são ordenadas de uma vez (`DataFrame.rank` em 2D), sem laço
+    por coluna. Sem dados faltantes, Pearson sobre os postos dá a correlação de
+    Spearman; com faltantes, os postos são os da coluna inteira, antes da
+    exclusão dos pares incompletos, e o resultado é uma aproximação.
+    """
+    return pd.DataFrame(M).rank(method='average').to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def correlacao_parcial_pareada(X, Y, z, min_amostras=1, devolver_controle=False):
+    """Correlação parcial entre cada coluna de X e cada coluna de Y, controlando por `z`.
+
+    Equivale a correlacionar os resíduos de X e de Y na regressão linear sobre
+    `z` (com intercepto), ajustada nas linhas em que o par existe. As somas de
+    cada par vêm de produtos matriciais mascarados, como em
+    `correlacao_pareada`. Se `z` não varia nas linhas do par, o resultado é a
+    própria correlação de Pearson. Retorna (correlações, n por par) e, com
+    `devolver_controle`, também a máscara dos pares em que `z` variou (e foi
+    de fato controlado), para descontar o grau de liberdade só neles.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64).reshape(-1, 1)
+
+    # Linhas sem o controle ficam de fora de todos os pares
+    validas_z = ~np.isnan(z)
+    mx = ~np.isnan(X) & validas_z
+    my = ~np.isnan(Y) & validas_z
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        media_x = np.nan_to_num(np.where(mx, X, 0.0).sum(axis=0) / mx.sum(axis=0))
+        media_y = np.nan_to_num(np.where(my, Y, 0.0).sum(axis=0) / my.sum(axis=0))
+    X = np.where(mx, X - media_x, 0.0)
+    Y = np.where(my, Y - media_y, 0.0)
+    media_z = np.nanmean(z) if validas_z.any() else 0.0
+    z = np.where(validas_z, z - media_z, 0.0)
+
+    mxf = mx.astype(np.float64)
+    myf = my.astype(np.float64)
+    zx = mxf * z
+
+    n = mxf.T @ myf
+    soma_x = X.T @ myf
+    soma_y = mxf.T @ Y
+    soma_z = zx.T @ myf
+    soma_xx = (X * X).T @ myf
+    soma_yy = mxf.T @ (Y * Y)
+    soma_zz = (zx * z).T @ myf
+    soma_xy = X.T @ Y
+    soma_xz = (X * z).T @ myf
+    soma_yz = mxf.T @ (Y * z)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov_xy = soma_xy - soma_x * soma_y / n
+        cov_xz = soma_xz - soma_x * soma_z / n
+        cov_yz = soma_yz - soma_y * soma_z / n
+        var_x = soma_xx - soma_x * soma_x / n
+        var_y = soma_yy - soma_y * soma_y / n
+        var_z = soma_zz - soma_z * soma_z / n
+
+        # Remove a parte explicada por z; sem variação de z, nada a remover
+        com_z = var_z > soma_zz * 1e-12
+        var_z = np.where(com_z, var_z, 1.0)
+        cov_xy = cov_xy - np.where(com_z, cov_xz * cov_yz / var_z, 0.0)
+        var_x = var_x - np.where(com_z, cov_xz * cov_xz / var_z, 0.0)
+        var_y = var_y - np.where(com_z, cov_yz * cov_yz / var_z, 0.0)
+
+        var_x = np.where(var_x > soma_xx * 1e-12, var_x, np.nan)
+        var_y = np.where(var_y > soma_yy * 1e-12, var_y, np.nan)
+        corr = np.clip(cov_xy / np.sqrt(var_x * var_y), -1.0, 1.0)
+
+    n = n.astype(np.int64)
+    corr[n < max(min_amostras, 3)] = np.nan
+    if devolver_controle:
+        return corr, n, com_z
+    return corr, n
+
+
+def significancia_correlacoes(corr, n, confianca=0.95, controles=0):
+    """p-valor bilateral e intervalo de confiança de Fisher-z, elemento a elemento.
+
+    `corr` e `n` (pares válidos) podem ter qualquer formato. O p-valor vem do
+    teste t com n - 2 graus de liberdade (o mesmo de `stats.linregress`); o
+    intervalo, de tanh(atanh(r) ± z / sqrt(n - 3)). Com n ≤ 3 o intervalo fica NaN.
+    Para correlações parciais, `controles` (variáveis controladas; escalar ou
+    por elemento) desconta esse número de graus de liberdade dos dois.
+    """
+    r = np.asarray(corr, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64) - controles
+    gl = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt(gl / ((1.0 - r) * (1.0 + r)))
+        p_valor = np.where(gl > 0, 2 * stats.t.sf(np.abs(t), np.maximum(gl, 1)), np.nan)
+        
+        z = np.arctanh(r)
+        margem = stats.norm.ppf(0.5 + confianca / 2) / np.sqrt(n - 3)
+        validos = n > 3
+        ic_inferior = np.where(validos, np.tanh(z - margem), np.nan)
+        ic_superior = np.where(validos, np.tanh(z + margem), np.nan)
+    return p_valor, ic_inferior, ic_superior
+
+
+def ajustar_fdr(p_valores):
+    """p-valores ajustados por Benjamini-Hochberg (controle da taxa de falsas descobertas).
+
+    O ajuste considera todos os p-valores não nulos do array; NaN continua NaN.
+    """
+    p = np.asarray(p_valores, dtype=np.float64)
+    ajustados = np.full(p.shape, np.nan)
+    validos = ~np.isnan(p)
+    m = int(validos.sum())
+    if m == 0:
+        return ajustados
+    
+    ordem = np.argsort(p[validos])
+    escalados = p[validos][ordem] * m / np.arange(1, m + 1)
+    # Mínimo acumulado a partir do maior p-valor garante a monotonicidade
+    escalados = np.minimum.accumulate(escalados[::-1])[::-1]
+    resultado = np.empty(m)
+    resultado[ordem] = np.minimum(escalados, 1.0)
+    ajustados[validos] = resultado
+    return ajustados
+
+
+def calcular_correlacoes(df, indice, metricas, min_amostras=1, linhas=None, clima=None, confianca=0.95,
+                         metodo='pearson', executor=None, vizinhanca=None):
+    """Tabela longa de correlações entre todas as colunas climáticas e as métricas.
+
+    `indice` é a tabela de `indexar_colunas_climaticas` (ou um recorte dela) e as
+    colunas são lidas pela posição. O resultado mantém o formato (e a ordem
+    métrica → coluna) das funções de correlação do dashboard, acrescido dos
+    metadados do índice. `linhas` restringe o cálculo a um recorte de `df`.
+    Com `clima` (`ColunasClimaticas`), as colunas climáticas vêm dele, e `df`
+    precisa ter só as métricas.
+    
+    Cada correlação traz também o n de pares válidos, o p-valor, o p-valor
+    ajustado por FDR (Benjamini-Hochberg, sobre todas as linhas da tabela) e o
+    intervalo de confiança de Fisher-z no nível `confianca`, tudo vetorizado.
+
+    `metodo` escolhe entre Pearson, postos (Pearson sobre os postos de cada
+    coluna no recorte, ≈ Spearman; ver `postos`) e correlação parcial
+    controlando o `ano`, que desconta o grau de liberdade só nos pares em que o
+    ano varia. Com `executor`
+    (`criar_pool_correlacoes`), os atributos são calculados em paralelo.
+
+    Com `vizinhanca` (`matriz_vizinhanca` das mesmas `linhas`), métricas e clima
+    são suavizados pela média dos municípios vizinhos no mesmo ano antes da
+    correlação. As linhas suavizadas não são independentes: os p-valores e
+    intervalos passam a ser apenas indicativos.
+    """
+    if _n_linhas(df, linhas) == 0 or len(indice) == 0:
+        return pd.DataFrame(columns=_colunas_tabela(indice))
+
+    corr, n, controles = _correlacoes_climaticas(df, indice, metricas, min_amostras, linhas, clima, metodo,
+                                                 executor, vizinhanca)
+    return _tabela_correlacoes(indice, metricas, corr, n, controles, confianca)
+
+
+def _colunas_tabela(indice):
+    return list(indice.columns) + ['Variável Soja', 'Correlação', 'Correlação Abs', 'n',
+                                   'p-valor', 'p-valor FDR', 'IC inferior', 'IC superior']
+
+
+def _tabela_correlacoes(indice, metricas, corr, n, controles, confianca):
+    """Tabela longa (métrica → coluna) a partir das matrizes de correlação, n e controles."""
+    # Ordem: métrica (externo) × coluna climática (interno)
+    valores = corr.T.ravel()
+    validos = ~np.isnan(valores)
+    n = n.T.ravel()[validos]
+    # O grau de liberdade do ano só sai onde ele variou (nunca nas tabelas de um único ano)
+    p_valor, ic_inferior, ic_superior = significancia_correlacoes(valores[validos], n, confianca,
+                                                                    controles=controles.T.ravel()[validos])
+    idx_coluna = np.tile(np.arange(len(indice)), len(metricas))[validos]
+    idx_metrica = np.repeat(np.arange(len(metricas)), len(indice))[validos]
+
+    # Montagem em uma só construção: inserir coluna a coluna custa mais que o cálculo
+    resultado = {coluna: indice[coluna].to_numpy()[idx_coluna] for coluna in indice.columns}
+    resultado.update({
+        'Variável Soja': np.asarray(metricas, dtype=object)[idx_metrica],
+        'Correlação': valores[validos],
+        'Correlação Abs': np.abs(valores[validos]),
+        'n': n,
+        'p-valor': p_valor,
+        'p-valor FDR': ajustar_fdr(p_valor),
+        'IC inferior': ic_inferior,
+        'IC superior': ic_superior,
+    })
+    return pd.DataFrame(resultado, columns=_colunas_tabela(indice))
+
+
+def tabelas_correlacao_por_ano(df, indice, metricas, min_amostras=1, linhas=None, clima=None,
+                               confianca=0.95, metodo='pearson', executor=None, vizinhanca=None):
+    """Tabelas de `calcular_correlacoes` para todos os anos e para cada ano, em um só lote.
+
+    Devolve {(ano, métrica): tabela sem a coluna 'Variável Soja'}, com `ano`
+    None para o recorte completo. Cada tabela equivale (a menos de arredondamento
+    da ordem das somas) à de `calcular_correlacoes(df, indice, [métrica],
+    linhas=<recorte do ano>, ...)`, inclusive o ajuste FDR, feito por tabela. As colunas climáticas são lidas uma
+    vez e correlacionadas com todos os anos do recorte (grupos de `ano`); com
+    `executor`, os atributos são divididos entre processos. A `vizinhanca` é a
+    do recorte `linhas` inteiro: como só liga linhas do mesmo ano, vale também
+    para as tabelas de cada ano.
+    """
+    anos = _matriz(df, ['ano'], linhas)[:, 0]
+    grupos = {None: slice(None)}
+    for ano in np.unique(anos[~np.isnan(anos)]):
+        grupos[int(ano)] = anos == ano
+
+    if len(anos) == 0 or len(indice) == 0:
+        correlacoes = {}
+    else:
+        correlacoes = _correlacoes_por_grupo(df, indice, metricas, min_amostras, linhas, clima, metodo, grupos,
+                                             executor, vizinhanca)
+
+    tabelas = {}
+    for ano, (corr, n, controles) in correlacoes.items():
+        for j, metrica in enumerate(metricas):
+            tabela = _tabela_correlacoes(indice, [metrica], corr[:, [j]], n[:, [j]], controles[:, [j]], confianca)
+            tabelas[(ano, metrica)] = tabela.drop(columns='Variável Soja')
+    return tabelas
+
+
+def montar_heatmap_correlacoes(df, indice, metrica, variaveis, min_amostras=6, linhas=None, clima=None,
+                               metodo='pearson', executor=None, vizinhanca=None):
+    """Matriz variável × período do ciclo da safra com as correlações com `metrica`.
+
+    Todas as colunas do ciclo (Ano1 Dec26-36, Ano2 Dec1-15) das `variaveis` são
+    correlacionadas em uma única passada; células com menos de `min_amostras`
+    pares válidos ficam de fora, e as colunas seguem a ordem do ciclo. Com
+    `clima`, só os blocos das `variaveis` são lidos. `metodo`, `executor` e
+    `vizinhanca` como em `calcular_correlacoes`.
+    """
+    selecao = indice[indice['Variável Climática'].isin(variaveis) & indice['Período'].notna()]
+    if _n_linhas(df, linhas) == 0 or len(selecao) == 0:
+        return pd.DataFrame()
+
+    corr, _, _ = _correlacoes_climaticas(df, selecao, [metrica], min_amostras, linhas, clima, metodo, executor,
+                                         vizinhanca)
+    return _pivotar_heatmap(selecao, corr[:, 0])
+
+
+def heatmap_da_tabela(tabela, variaveis):
+    """Mesmo resultado de `montar_heatmap_correlacoes`, a partir de uma tabela já calculada.
+
+    `tabela` vem de `tabelas_correlacao_por_ano` (ou de `calcular_correlacoes`
+    com uma métrica) com o mesmo `min_amostras`; nada é recalculado.
+    """
+    selecao = tabela[tabela['Variável Climática'].isin(variaveis) & tabela['Período'].notna()]
+    return _pivotar_heatmap(selecao, selecao['Correlação'].to_numpy())
+
+
+def _pivotar_heatmap(selecao, correlacoes):
+    df_heatmap = pd.DataFrame({
+        'Variável': selecao['Variável Climática'].to_numpy(),
+        'Período': selecao['Período'].to_numpy(),
+        'Decêndio_Order': selecao['Decêndio_Order'].to_numpy(),
+        'Correlação': correlacoes,
+    }).dropna(subset=['Correlação'])
+    if len(df_heatmap) == 0:
+        return pd.DataFrame()
+
+    pivot_heatmap = df_heatmap.pivot_table(
+        values='Correlação',
+        index='Variável',
+        columns='Período',
+        aggfunc='first'
+    )
+    colunas_ordenadas = df_heatmap.sort_values('Decêndio_Order', kind='stable')['Período'].unique()
+    return pivot_heatmap[colunas_ordenadas]
+
+
+def medias_por_fase(pivot_heatmap):
+    """Correlação média de cada fase da safra (`Ano1`, `Ano2`) no mapa de calor.
+
+    Média das médias por período; a fase sem colunas no pivot fica de fora.
+    """
+    medias = {}
+    for fase in ['Ano1', 'Ano2']:
+        colunas = [col for col in pivot_heatmap.columns if col.startswith(fase)]
+        if colunas:
+            medias[fase] = pivot_heatmap[colunas].mean().mean()
+    return medias
+
+
+def matriz_correlacao_producao(df, linhas=None, colunas=COLUNAS_CORRELACAO_PRODUCAO):
+    """Matriz de Pearson entre as variáveis de produção presentes no DataFrame.
+
+    Devolve None se houver menos de duas dessas colunas.
+    """
+    validas = [col for col in colunas if col in df.columns]
+    if len(validas) < 2:
+        return None
+    if linhas is None:
+        return df[validas].corr()
+    return df.loc[linhas, validas].corr()
+
+
+# ==========================================
+# CORRELAÇÕES EM PARALELO (PROCESSOS)
+# ==========================================
+def criar_pool_correlacoes(processos=None):
+    """Pool de processos para o modo paralelo das correlações (`executor=`).
+
+    Os processos são iniciados com `spawn`, seguro dentro de servidores com
+    threads como o Streamlit, e reaproveitados entre chamadas: cada um importa
+    este módulo uma única vez.
+    """
+    return ProcessPoolExecutor(max_workers=processos or os.cpu_count(),
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+def _compartilhar(arrays):
+    """Copia os arrays para um único segmento de memória compartilhada.
+
+    Devolve (segmento, descrição), com o deslocamento, a forma e o tipo de cada
+    array; os processos reabrem o segmento pelo nome, sem pickle dos dados.
+    """
+    arrays = {nome: np.ascontiguousarray(array) for nome, array in arrays.items()}
+    descricao = {}
+    tamanho = 0
+    for nome, array in arrays.items():
+        tamanho = -(-tamanho // 64) * 64
+        descricao[nome] = (tamanho, array.shape, array.dtype.str)
+        tamanho += array.nbytes
+
+    segmento = shared_memory.SharedMemory(create=True, size=max(tamanho, 1))
+    for nome, array in arrays.items():
+        inicio, forma, tipo = descricao[nome]
+        np.ndarray(forma, dtype=tipo, buffer=segmento.buf, offset=inicio)[...] = array
+    return segmento, descricao
+
+
+def _contexto_processo(segmento, descricao, metodo):
+    """Views do segmento da chamada e grupos preparados, no processo de trabalho."""
+    dados = {
+        nome: np.ndarray(forma, dtype=tipo, buffer=segmento.buf, offset=inicio)
+        for nome, (inicio, forma, tipo) in descricao.items()
+    }
+    grupos = dict(enumerate(dados['grupos']))
+    vizinhanca = None
+    if 'vizinhanca_indptr' in dados:
+        n = len(dados['Y'])
+        vizinhanca = sparse.csr_matrix(
+            (dados['vizinhanca_dados'], dados['vizinhanca_indices'], dados['vizinhanca_indptr']), shape=(n, n)
+        )
+    return {
+        'dados': dados,
+        'por_grupo': _preparar_grupos(dados['Y'], dados.get('anos'), grupos, metodo),
+        'vizinhanca': vizinhanca,
+    }
+
+
+def _calcular_bloco(segmento, descricao, fonte, min_amostras, metodo):
+    contexto = _contexto_processo(segmento, descricao, metodo)
+    dados = contexto['dados']
+    if fonte[0] == 'memoria':
+        X = dados[fonte[1]]
+    else:
+        _, caminho_cache, colunas = fonte
+        bloco = feather.read_table(caminho_cache, columns=colunas, memory_map=True).to_pandas()
+        X = _matriz(bloco, colunas, dados.get('linhas'))
+    X = _suavizar(contexto['vizinhanca'], X)
+    resultado = _correlacionar_bloco(X, contexto['por_grupo'], min_amostras, metodo)
+    return [resultado[i] for i in range(len(resultado))]
+
+
+def _tarefa_bloco(nome_segmento, descricao, fonte, min_amostras, metodo):
+    """Correlações de um bloco no processo de trabalho; devolve [(corr, n, controles)] na ordem dos grupos.
+
+    `fonte` é ('memoria', nome do array no segmento) ou ('arquivo', cache
+    Feather, colunas): o bloco é lido do arquivo mapeado em memória, que o
+    sistema compartilha entre os processos. O segmento é anexado só durante a
+    tarefa: depois do `unlink` no processo principal, nenhum processo de
+    trabalho mantém a memória do lote.
+    """
+    segmento = shared_memory.SharedMemory(name=nome_segmento)
+    try:
+        # As views do segmento vivem só dentro de `_calcular_bloco`
+        return _calcular_bloco(segmento, descricao, fonte, min_amostras, metodo)
+    finally:
+        try:
+            segmento.close()
+        except BufferError:
+            # Views presas no traceback de uma exceção; saem junto com ele
+            pass
+
+
+def _correlacoes_em_paralelo(executor, df, indice, Y, anos, grupos, linhas, clima, min_amostras, metodo,
+                             vizinhanca=None):
+    """Distribui os blocos (atributos) entre os processos; devolve [(posições, {chave: (corr, n, controles)})].
+
+    Métricas (já suavizadas), ano, grupos, os arrays CSR da `vizinhanca` e, sem
+    `clima`, as matrizes climáticas vão para um segmento de memória
+    compartilhada, liberado ao final. Os grupos viram máscaras booleanas; o
+    cálculo de cada bloco é o mesmo da execução em série.
+    """
+    mascaras = np.zeros((len(grupos), len(Y)), dtype=bool)
+    for i, selecao in enumerate(grupos.values()):
+        mascaras[i, selecao] = True
+    dados = {'Y': Y, 'grupos': mascaras}
+    if anos is not None:
+        dados['anos'] = anos
+    if vizinhanca is not None:
+        dados['vizinhanca_dados'] = vizinhanca.data
+        dados['vizinhanca_indices'] = vizinhanca.indices
+        dados['vizinhanca_indptr'] = vizinhanca.indptr
+
+    atributos = list(indice.groupby('Variável Climática', sort=False).indices.values())
+    colunas = indice['Coluna'].to_numpy()
+    if clima is None:
+        matriz = _matriz_climatica(df, indice, linhas)
+        fontes = []
+        for i, posicoes in enumerate(atributos):
+            dados[f'X{i}'] = matriz[:, posicoes]
+            fontes.append(('memoria', f'X{i}'))
+        del matriz
+    else:
+        if isinstance(linhas, slice):
+            # Fatia sobre as linhas de `df` (as mesmas do cache): vira máscara
+            mascara = np.zeros(len(df), dtype=bool)
+            mascara[linhas] = True
+            linhas = mascara
+        if linhas is not None:
+            dados['linhas'] = np.asarray(linhas)
+        fontes = [('arquivo', clima.caminho_cache, list(colunas[posicoes])) for posicoes in atributos]
+
+    segmento, descricao = _compartilhar(dados)
+    del dados
+    try:
+        futuros = [executor.submit(_tarefa_bloco, segmento.name, descricao, fonte, min_amostras, metodo)
+                   for fonte in fontes]
+        chaves = list(grupos)
+        return [(posicoes, dict(zip(chaves, futuro.result()))) for posicoes, futuro in zip(atributos, futuros)]
+    finally:
+        segmento.close()
+        segmento.unlink()
+
+
+# ==========================================
+# FORMATAÇÃO PT-BR
+# ==========================================
+def formatar_numero(valor, prefixo='', sufixo='', decimais=0):
+    """Formata números para o padrão brasileiro (1.000,00).
+    
+    Para Series, arrays e tabelas inteiras use `formatar_numeros`, que faz o mesmo
+    em lote.
+    """
+    if pd.isna(valor):
+        return "-"
+    
+    # Formata primeiro no padrão americano para garantir a precisão
+    if decimais > 0:
+        s = f"{valor:,.{decimais}f}"
+    else:
+        s = f"{valor:,.0f}"
+    
+    # Inverte os caracteres: vírgula vira X, ponto vira vírgula, X vira ponto
+    # Ex: 1,234.56 -> 1X234.56 -> 1X234,56 -> 1.234,56
+    s = s.replace(',', 'X').replace('.', ',').replace('X', '.')
+    
+    return f"{prefixo}{s}{sufixo}".strip()
+
+
+def formatar_p_valor(p):
+    """p-valor em PT-BR com 4 casas; abaixo de 0,0001 mostra "< 0,0001"."""
+    if pd.isna(p):
+        return "-"
+    if p < 1e-4:
+        return "< 0,0001"
+    return formatar_numero(p, decimais=4)
+
+
+def formatar_numeros(valores, prefixo='', sufixo='', decimais=0):
+    """Versão vetorizada de `formatar_numero` (1.000,00; NaN → "-").
+
+    Aceita array, Series ou DataFrame e devolve strings no mesmo formato do
+    argumento. Os dígitos são escritos por aritmética inteira direto num buffer
+    de bytes (uma linha por valor), sem formatar elemento a elemento no Python.
+    """
+    formato = np.shape(valores)
+    v = np.asarray(valores, dtype=np.float64).ravel()
+    n = len(v)
+    
+    escala = 10 ** decimais
+    # Acima de ~2**40 após a escala, ou em empates exatos de ,5, o arredondamento
+    # do float pode divergir do `format` do Python: esses valores (raros) usam a
+    # formatação escalar
+    produto = np.abs(np.where(np.isfinite(v), v, 0.0)) * escala
+    rapido = np.isfinite(v) & (produto < 2 ** 40) & (produto - np.floor(produto) != 0.5)
+    
+    escalados = np.rint(np.where(rapido, produto, 0.0)).astype(np.int64)
+    inteiro = escalados // escala
+    fracao = escalados % escala
+    
+    potencias = 10 ** np.arange(1, 19, dtype=np.int64)
+    n_digitos = 1 + (inteiro[:, None] >= potencias[None, :]).sum(axis=1)
+    negativo = np.signbit(v) & rapido
+    fim_inteiro = negativo + n_digitos + (n_digitos - 1) // 3
+    largura = int(fim_inteiro.max() + (decimais + 1 if decimais > 0 else 0)) if n else 1
+    
+    buffer = np.zeros((n, largura), dtype=np.uint8)
+    linhas = np.arange(n)
+    buffer[negativo, 0] = ord('-')
+    for k in range(int(n_digitos.max()) if n else 0):
+        ativo = k < n_digitos
+        coluna = fim_inteiro - 1 - (k + k // 3)
+        buffer[linhas[ativo], coluna[ativo]] = ord('0') + (inteiro[ativo] // 10 ** k) % 10
+        if k > 0 and k % 3 == 0:
+            buffer[linhas[ativo], coluna[ativo] + 1] = ord('.')
+    if decimais > 0:
+        buffer[linhas, fim_inteiro] = ord(',')
+        for k in range(decimais):
+            buffer[linhas, fim_inteiro + decimais - k] = ord('0') + (fracao // 10 ** k) % 10
+    
+    # Bytes nulos ao final são descartados pelo dtype 'S'
+    texto = buffer.view(f'S{largura}').ravel().astype(f'U{largura}').astype(object)
+    
+    for i in np.flatnonzero(~rapido & ~np.isnan(v)):
+        s = f"{v[i]:,.{decimais}f}"
+        texto[i] = s.replace(',', 'X').replace('.', ',').replace('X', '.')
+    
+    if prefixo or sufixo:
+        texto = prefixo + texto + sufixo
+        if prefixo[:1].isspace() or sufixo[-1:].isspace():
+            texto = np.array([t.strip() for t in texto], dtype=object)
+    texto[np.isnan(v)] = '-'
+    
+    texto = texto.reshape(formato)
+    if isinstance(valores, pd.DataFrame):
+        return pd.DataFrame(texto, index=valores.index, columns=valores.columns)
+    if isinstance(valores, pd.Series):
+        return pd.Series(texto, index=valores.index, name=valores.name, dtype=object)
+    return texto
+
+
+# ==========================================
+# MAPA 3D
+# ==========================================
+# Definição do Color Range
+COLOR_RANGE = [
+    [255, 255, 178], [254, 204, 92], [253, 141, 60],
+    [240, 59, 32], [189, 0, 38], [128, 0, 38]
+]
+
+# Métricas disponíveis no mapa
+METRICAS_MAPA = [
+    "Quantidade produzida (Toneladas)", 
+    "Rendimento médio da produção (Quilogramas por Hectare)",
+    "Área perdida (Hectares)",
+    "Percentual de perda (%)",
+    "Valor da produção (Mil Reais)"
+]
+
+
+def montar_dados_mapa(df_municipios, df, linhas, metricas=METRICAS_MAPA):
+    """Coordenadas dos municípios + métricas das linhas selecionadas (merge por código IBGE)."""
+    df_ano_mapa = df.loc[linhas, ['codigo_ibge'] + list(metricas)]
+    return df_municipios.merge(df_ano_mapa, on='codigo_ibge', how='inner')
+
+
+# Níveis de detalhe do mapa: (zoom mínimo, lado da célula da grade em km);
+# None desenha um ponto por município. O zoom de um estado (6,5) fica nos municípios
+NIVEIS_DETALHE_MAPA = [(6.0, None), (5.0, 25), (4.5, 50), (0.0, 100)]
+
+# Até este número de municípios o mapa nunca é agregado (o Paraná tem ~400)
+MAX_MUNICIPIOS_SEM_GRADE = 1000
+
+# Quilômetros por grau de latitude
+KM_POR_GRAU = 111.32
+
+
+def lado_celula_para_zoom(zoom, n_municipios=None, niveis=NIVEIS_DETALHE_MAPA):
+    """Lado da célula (km) da grade para o `zoom` do mapa, ou None para os municípios.
+
+    Com até `MAX_MUNICIPIOS_SEM_GRADE` municípios no mapa, fica sempre nos
+    municípios: a agregação só vale a pena para vistas grandes.
+    """
+    if n_municipios is not None and n_municipios <= MAX_MUNICIPIOS_SEM_GRADE:
+        return None
+    for zoom_minimo, lado_km in niveis:
+        if zoom >= zoom_minimo:
+            return lado_km
+    return niveis[-1][1]
+
+
+def agregar_mapa_em_grade(df_mapa, lado_km, metricas=METRICAS_MAPA):
+    """Municípios do mapa agrupados em células de aproximadamente `lado_km` × `lado_km`.
+
+    A grade tem faixas de latitude fixas e, em cada faixa, a largura em
+    longitude corrigida pelo cosseno da latitude, de modo que as células têm
+    área parecida do Sul ao Norte. Cada célula fica no centroide dos seus
+    municípios; as métricas são somadas ou têm a média por município, como em
+    `AGREGACAO_ANUAL`. `nome` descreve a célula no tooltip e `Municípios`
+    conta os municípios agregados.
+    """
+    lat = df_mapa['lat'].to_numpy(dtype=np.float64)
+    lon = df_mapa['lon'].to_numpy(dtype=np.float64)
+    passo_lat = lado_km / KM_POR_GRAU
+    faixa = np.floor(lat / passo_lat)
+    passo_lon = passo_lat / np.cos(np.radians((faixa + 0.5) * passo_lat))
+    coluna = np.floor(lon / passo_lon)
+    
+    grupos = df_mapa.groupby([faixa.astype(np.int64), coluna.astype(np.int64)], sort=False)
+    agregacao = {'lat': 'mean', 'lon': 'mean', 'nome': ['first', 'size']}
+    agregacao.update({metrica: AGREGACAO_ANUAL.get(metrica, 'mean') for metrica in metricas})
+    grade = grupos.agg(agregacao)
+    grade.columns = ['lat', 'lon', 'nome', 'Municípios'] + list(metricas)
+    
+    varios = grade['Municípios'] > 1
+    grade.loc[varios, 'nome'] = formatar_numeros(grade.loc[varios, 'Municípios']) + ' municípios'
+    return grade.reset_index(drop=True)
+
+
+def preparar_camada_mapa(df_mapa, metrica, elevation_max, color_range=COLOR_RANGE):
+    """Novo DataFrame só com as colunas usadas pela ColumnLayer; `df_mapa` não é alterado.
+
+    `lon`, `lat` e `nome` do mapa, mais `metrica_viz` (valor), `metrica_viz_fmt`
+    (texto do tooltip), `elevation` (altura normalizada pelo máximo) e
+    `fill_color` (RGBA), tudo vetorizado.
+    """
+    valores = df_mapa[metrica]
+    camada = df_mapa[['lon', 'lat', 'nome']].copy()
+    camada['metrica_viz'] = valores
+    
+    # Se for percentual, usa 2 casas, se não, usa 0
+    decimais = 2 if "Percentual" in metrica else 0
+    camada['metrica_viz_fmt'] = formatar_numeros(valores, decimais=decimais)
+    
+    # Normalizar para cor e elevação
+    camada['elevation'] = (valores / valores.max()) * elevation_max
+    camada['fill_color'] = mapear_cores(valores, color_range).tolist()
+    return camada
+
+
+# Casas decimais das coordenadas enviadas ao mapa (5 casas ≈ 1 m)
+DECIMAIS_POSICAO_MAPA = 5
+
+
+def compactar_camada_mapa(df_camada, decimais=DECIMAIS_POSICAO_MAPA):
+    """Só o que a ColumnLayer desenha, em tipos compactos, com chaves curtas.
+
+    A partir do DataFrame de `preparar_camada_mapa`: `p` é a posição
+    [lon, lat] arredondada a `decimais` casas, `e` a elevação inteira, `c` o
+    RGBA em inteiros de 0 a 255, `nome` e `v` (valor formatado) o tooltip. O
+    JSON do deck cresce só com as linhas e as colunas desenhadas, sem os
+    floats longos e as colunas herdadas do `municipios.csv`.
+    """
+    return _camada_compacta(
+        df_camada[['lon', 'lat']].to_numpy(dtype=np.float64),
+        df_camada['elevation'].to_numpy(dtype=np.float64),
+        np.asarray(df_camada['fill_color'].tolist(), dtype=np.uint8).reshape(len(df_camada), 4),
+        df_camada['nome'].to_numpy(),
+        df_camada['metrica_viz_fmt'].to_numpy(),
+        decimais,
+    )
+
+
+def _camada_compacta(posicoes, elevacao, cores, nomes, textos, decimais=DECIMAIS_POSICAO_MAPA):
+    """DataFrame `p`/`e`/`c`/`nome`/`v` de `compactar_camada_mapa` a partir dos arrays."""
+    return pd.DataFrame({
+        'p': np.round(posicoes, decimais).tolist(),
+        'e': np.rint(np.nan_to_num(elevacao)).astype(np.int64),
+        'c': np.asarray(cores, dtype=np.uint8).tolist(),
+        'nome': nomes,
+        'v': textos,
+    })
+
+
+def quadros_mapa(df_municipios, df, linhas, metrica, elevation_max, color_range=COLOR_RANGE):
+    """Quadros da animação do mapa: {ano: camada compacta}, com `valores` para a legenda.
+
+    Devolve `(quadros, valores)`. Os valores de `metrica` nas `linhas` viram
+    uma matriz município × ano (um merge com as coordenadas para todos os
+    anos), e elevação, cor e texto do tooltip saem de uma só passada
+    vetorizada sobre a matriz. A escala de cor e de altura é a de todos os
+    anos juntos, para que os quadros sejam comparáveis; municípios sem valor
+    no ano ficam fora do quadro. Cada quadro tem o formato de
+    `compactar_camada_mapa`.
+    """
+    dados = df.loc[linhas, ['codigo_ibge', 'ano', metrica]]
+    tabela = dados.groupby(['codigo_ibge', 'ano'], sort=True)[metrica].first().unstack('ano')
+    anos = list(tabela.columns)
+    municipios = df_municipios[['codigo_ibge', 'nome', 'lon', 'lat']].merge(
+        tabela, left_on='codigo_ibge', right_index=True, how='inner'
+    )
+    V = municipios[anos].to_numpy(dtype=np.float64)
+    if V.size == 0:
+        return {}, pd.Series(dtype=np.float64)
+
+    maximo = np.nanmax(V) if not np.isnan(V).all() else np.nan
+    elevacao = V / maximo * elevation_max if maximo > 0 else np.zeros_like(V)
+    cores = mapear_cores(V.ravel(), color_range).reshape(V.shape + (4,))
+    textos = formatar_numeros(V, decimais=2 if "Percentual" in metrica else 0)
+
+    posicoes = municipios[['lon', 'lat']].to_numpy(dtype=np.float64)
+    nomes = municipios['nome'].to_numpy()
+    quadros = {}
+    for j, ano in enumerate(anos):
+        presentes = ~np.isnan(V[:, j])
+        quadros[int(ano)] = _camada_compacta(posicoes[presentes], elevacao[presentes, j], cores[presentes, j],
+                                             nomes[presentes], textos[presentes, j])
+    return quadros, pd.Series(V[~np.isnan(V)], name=metrica)
+
+
+def mapear_cores(valores, color_range, alpha=200):
+    """Cor RGBA (matriz n × 4) de cada valor, por faixas iguais entre mínimo e máximo.
+
+    Valores nulos, zero ou NaN (ou máximo igual a zero) ficam em cinza.
+    """
+    v = np.asarray(valores, dtype=np.float64)
+    paleta = np.column_stack([np.asarray(color_range), np.full(len(color_range), alpha)])
+    cores = np.tile(np.array([150, 150, 150, alpha]), (len(v), 1))
+    
+    if len(v) == 0 or np.isnan(v).all():
+        return cores.astype(np.uint8)
+    
+    data_min = np.nanmin(v)
+    data_max = np.nanmax(v)
+    if data_max == 0:
+        return cores.astype(np.uint8)
+    
+    amplitude = data_max - data_min
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalizado = (v - data_min) / amplitude if amplitude > 0 else np.zeros_like(v)
+    coloridos = ~np.isnan(v) & (v != 0)
+    faixa = (normalizado[coloridos] * (len(color_range) - 1)).astype(np.int64)
+    cores[coloridos] = paleta[faixa]
+    return cores.astype(np.uint8)
+
+
+def faixas_legenda(valores, n_faixas):
+    """Mínimo e limites superiores das `n_faixas` faixas iguais da legenda de cores."""
+    valores = pd.Series(valores, dtype=np.float64)
+    min_val = valores.min()
+    max_val = valores.max()
+    step = (max_val - min_val) / n_faixas
+    return min_val, [min_val + (i + 1) * step for i in range(n_faixas)]
+
+
+# ==========================================
+# CHAVES DE CACHE
+# ==========================================
+def impressao_filtro(anos, codigos_municipios, *extras):
+    """Impressão digital curta e estável de um recorte (anos × municípios).
+
+    Usada como chave de `st.cache_data` no lugar do DataFrame filtrado: depende só
+    dos anos e códigos IBGE ordenados (e de `extras`, se houver), então é barata de
+    calcular e não exige hashear as centenas de colunas climáticas.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.unique(np.asarray(anos, dtype=np.int64)).tobytes())
+    h.update(b'|')
+    h.update(np.unique(np.asarray(codigos_municipios, dtype=np.int64)).tobytes())
+    for extra in extras:
+        h.update(b'|')
+        h.update(repr(extra).encode('utf-8'))
+    return h.hexdigest()
+
+
+# ==========================================
+# CUBO ANO × MUNICÍPIO (PRODUÇÃO)
+# ==========================================
+# Agregação anual dos indicadores: medidas somadas ou com média por registro
+AGREGACAO_ANUAL = {
+    'Área plantada (Hectares)': 'sum',
+    'Área colhida (Hectares)': 'sum',
+    'Área perdida (Hectares)': 'sum',
+    'Percentual de perda (%)': 'mean',
+    'Quantidade produzida (Toneladas)': 'sum',
+    'Valor da produção (Mil Reais)': 'sum',
+    'Rendimento médio da produção (Quilogramas por Hectare)': 'mean'
+}
+MEDIDAS_PRODUCAO = list(AGREGACAO_ANUAL)
+
+# Medidas dos rankings de municípios
+MEDIDAS_RANKING = [
+    'Quantidade produzida (Toneladas)',
+    'Rendimento médio da produção (Quilogramas por Hectare)',
+    'Área plantada (Hectares)',
+    'Valor da produção (Mil Reais)'
+]
+
+
+def montar_cubo_producao(df):
+    """Cubo ano × município só com as medidas de produção.
+
+    Para cada medida guarda a soma e a quantidade de valores não nulos (`n <medida>`),
+    de modo que somas e médias de qualquer recorte saem do cubo sem voltar ao
+    DataFrame completo. `Registros` é o número de linhas originais da célula.
+    """
+    grupos = df.groupby(['ano', 'Município'], observed=True, sort=True)
+    return pd.concat([
+        grupos['codigo_ibge'].first(),
+        grupos.size().rename('Registros'),
+        grupos[MEDIDAS_PRODUCAO].sum(),
+        grupos[MEDIDAS_PRODUCAO].count().add_prefix('n '),
+    ], axis=1).reset_index()
+
+
+def recortar_cubo(cubo, anos, municipios):
+    """Células do cubo dentro do recorte de anos e municípios."""
+    return cubo[cubo['ano'].isin(anos) & cubo['Município'].isin(municipios)]
+
+
+def _somas_e_medias(grupos, medidas, como):
+    somas = grupos[medidas].sum()
+    for medida in medidas:
+        if como(medida) == 'mean':
+            somas[medida] = somas[medida] / grupos[f'n {medida}'].sum()
+    return somas
+
+
+def agregar_por_ano(cubo):
+    """Indicadores anuais (somas e médias por registro), como o `groupby('ano')` do dashboard."""
+    grupos = cubo.groupby('ano', sort=True)
+    return _somas_e_medias(grupos, MEDIDAS_PRODUCAO, AGREGACAO_ANUAL.get).reset_index()
+
+
+def media_por_municipio(cubo, medidas):
+    """Média por registro de cada medida, por município, sobre os anos do cubo."""
+    grupos = cubo.groupby('Município', observed=True, sort=True)
+    return _somas_e_medias(grupos, list(medidas), lambda medida: 'mean')
+
+
+def evolucao_por_municipio(cubo, medidas):
+    """Pivot ano × município de cada medida (média por registro), direto do cubo.
+
+    As colunas são (medida, município); uma única passada atende todos os
+    gráficos de evolução dos municípios.
+    """
+    medias = pd.DataFrame(
+        {medida: (cubo[medida] / cubo[f'n {medida}']).to_numpy() for medida in medidas},
+        index=pd.MultiIndex.from_frame(cubo[['ano', 'Município']]),
+    )
+    return medias.unstack('Município').sort_index()
@@ -0,0 +1,343 @@
+"""Benchmark do pipeline de dados do dashboard, fora do Streamlit.
+
+Gera uma base sintética no formato PAM/SIDRA + NASA POWER (municípios × anos ×
+decêndios climáticos), executa cada etapa do pipeline e mede tempo de parede
+(mediana das repetições) e pico de memória (tracemalloc) por etapa. O
+tracemalloc vê as alocações do Python/NumPy, não as do pool do Arrow, então a
+leitura do cache Feather (mapeada em memória) aparece quase sem custo.
+
+Uso:
+    python benchmark.py                          # tamanho padrão
+    python benchmark.py --municipios 5570 --atributos 20
+    python benchmark.py --salvar                 # grava a linha de base
+    python benchmark.py --comparar               # compara com a linha de base
+    python benchmark.py --processos 4            # inclui o lote de correlações em paralelo
+
+A linha de base fica em .benchmarks/baseline.json, separada por cenário
+(parâmetros da base sintética). Roda offline: só precisa das dependências do
+dashboard e, se existir, do municipios.csv para as coordenadas.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from analise import (
+    DECENDIOS_ANO1,
+    DECENDIOS_ANO2,
+    IndiceEspacial,
+    METRICAS_FOCO,
+    VARIAVEIS_SOJA,
+    abrir_dados_sob_demanda,
+    agregar_mapa_em_grade,
+    calcular_correlacoes,
+    compactar_camada_mapa,
+    carregar_dados_preparados,
+    criar_pool_correlacoes,
+    indexar_colunas_climaticas,
+    matriz_vizinhanca,
+    montar_cubo_producao,
+    montar_heatmap_correlacoes,
+    preparar_camada_mapa,
+    quadros_mapa,
+    tabelas_correlacao_por_ano,
+)
+
+ARQUIVO_BASELINE = os.path.join('.benchmarks', 'baseline.json')
+
+
+# ==========================================
+# BASE SINTÉTICA
+# ==========================================
+def gerar_municipios(n_municipios, semente=0):
+    """Municípios com código IBGE e coordenadas (do municipios.csv, se disponível)."""
+    if os.path.exists('municipios.csv'):
+        municipios = pd.read_csv('municipios.csv')
+        if n_municipios <= len(municipios):
+            return municipios.sample(n=n_municipios, random_state=semente).reset_index(drop=True)
+
+    rng = np.random.default_rng(semente)
+    return pd.DataFrame({
+        'codigo_ibge': 1100000 + np.arange(n_municipios),
+        'nome': [f"Município {i}" for i in range(n_municipios)],
+        'latitude': rng.uniform(-33.7, 5.3, n_municipios),
+        'longitude': rng.uniform(-73.9, -34.8, n_municipios),
+        'codigo_uf': 41,
+    })
+
+
+def gerar_base_sintetica(municipios, n_anos, n_atributos, decendios_completos=False,
+                         fracao_nula=0.02, semente=0):
+    """DataFrame bruto no formato do CSV PAM_SIDRA_NASAPOWER (antes de `preparar_dados`)."""
+    rng = np.random.default_rng(semente)
+    anos = np.arange(2024 - n_anos + 1, 2025)
+    n = len(municipios) * len(anos)
+
+    plantada = rng.uniform(500, 100000, n)
+    colhida = plantada * rng.uniform(0.7, 1.0, n)
+    rendimento = rng.normal(3300, 500, n)
+    producao = colhida * rendimento / 1e6
+
+    base = {
+        'Município': np.tile(municipios['nome'].astype(str).to_numpy(), len(anos)),
+        'Código IBGE': np.tile(municipios['codigo_ibge'].to_numpy(), len(anos)),
+        'ano': np.repeat(anos, len(municipios)),
+        'Área plantada (Hectares)': plantada,
+        'Área colhida (Hectares)': colhida,
+        'Quantidade produzida (Toneladas)': producao,
+        'Rendimento médio da produção (Quilogramas por Hectare)': rendimento,
+        'Valor da produção (Mil Reais)': producao * rng.uniform(1.8, 2.6, n),
+        'Valor da produção - percentual do total geral': rng.uniform(0, 1, n),
+    }
+
+    if decendios_completos:
+        periodos = [(d, 1) for d in range(1, 37)] + [(d, 2) for d in range(1, 37)]
+    else:
+        periodos = [(d, 1) for d in DECENDIOS_ANO1] + [(d, 2) for d in DECENDIOS_ANO2]
+
+    clima = rng.normal(20, 5, (n, n_atributos * len(periodos)))
+    clima[rng.random(clima.shape) < fracao_nula] = np.nan
+    nomes = [f"ATRIB{a:02d}_dec{d}_ano{s}" for a in range(n_atributos) for d, s in periodos]
+
+    return pd.concat([pd.DataFrame(base), pd.DataFrame(clima, columns=nomes)], axis=1)
+
+
+# ==========================================
+# MEDIÇÃO
+# ==========================================
+def medir(funcao, repeticoes):
+    """Executa `funcao` e devolve (resultado, mediana do tempo em s, pico de memória em MB)."""
+    tempos = []
+    pico = 0
+    resultado = None
+    for _ in range(repeticoes):
+        resultado = None
+        gc.collect()
+        tracemalloc.start()
+        inicio = time.perf_counter()
+        resultado = funcao()
+        tempos.append(time.perf_counter() - inicio)
+        pico = max(pico, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return resultado, statistics.median(tempos), pico / 2 ** 20
+
+
+def executar(args):
+    """Roda todas as etapas e devolve {etapa: {'tempo_s', 'pico_mb'}}."""
+    municipios = gerar_municipios(args.municipios, args.semente)
+    bruto = gerar_base_sintetica(municipios, args.anos, args.atributos,
+                                 args.decendios_completos, semente=args.semente)
+    etapas = {}
+
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho_csv = os.path.join(pasta, 'PAM_SIDRA_NASAPOWER_SINTETICO.csv')
+        bruto.to_csv(caminho_csv, index=False)
+        del bruto
+
+        def carregar_frio():
+            # Sem cache: parse do CSV, preparação e gravação do Feather
+            cache = os.path.join(pasta, '.cache_dados')
+            if os.path.isdir(cache):
+                for arquivo in os.listdir(cache):
+                    os.remove(os.path.join(cache, arquivo))
+            return carregar_dados_preparados(caminho_csv)
+
+        _, t, m = medir(carregar_frio, args.repeticoes)
+        etapas['carregar_dados (CSV)'] = (t, m)
+        df, t, m = medir(lambda: carregar_dados_preparados(caminho_csv), args.repeticoes)
+        etapas['carregar_dados (cache)'] = (t, m)
+
+        def heatmap_sob_demanda():
+            # Armazém novo a cada repetição: inclui a leitura dos blocos dos 5 atributos
+            producao, indice_arquivo, clima = abrir_dados_sob_demanda(caminho_csv)
+            variaveis = sorted(indice_arquivo['Variável Climática'].unique())[:5]
+            return montar_heatmap_correlacoes(producao, indice_arquivo, VARIAVEIS_SOJA[0], variaveis,
+                                              clima=clima)
+
+        _, t, m = medir(heatmap_sob_demanda, args.repeticoes)
+        etapas['heatmap (clima sob demanda)'] = (t, m)
+
+    indice, t, m = medir(lambda: indexar_colunas_climaticas(df.columns), args.repeticoes)
+    etapas['indexar_colunas_climaticas'] = (t, m)
+
+    _, t, m = medir(lambda: calcular_correlacoes(df, indice, VARIAVEIS_SOJA), args.repeticoes)
+    etapas['calcular_correlacoes_relevantes'] = (t, m)
+
+    ultimo_ano = df['ano'].max()
+    linhas_ano = (df['ano'] == ultimo_ano).to_numpy()
+    _, t, m = medir(lambda: calcular_correlacoes(df, indice, [VARIAVEIS_SOJA[0]], min_amostras=6,
+                                                 linhas=linhas_ano), args.repeticoes)
+    etapas['calcular_correlacoes_por_ano'] = (t, m)
+
+    _, t, m = medir(lambda: tabelas_correlacao_por_ano(df, indice, METRICAS_FOCO, min_amostras=6),
+                    args.repeticoes)
+    etapas['tabelas_correlacao_por_ano (lote)'] = (t, m)
+
+    if args.processos > 1:
+        serie = tabelas_correlacao_por_ano(df, indice, METRICAS_FOCO, min_amostras=6)
+        with criar_pool_correlacoes(args.processos) as pool:
+            # Aquecimento: inicia os processos fora da medição
+            tabelas_correlacao_por_ano(df, indice.head(1), METRICAS_FOCO[:1], executor=pool)
+            paralelo, t, m = medir(lambda: tabelas_correlacao_por_ano(df, indice, METRICAS_FOCO, min_amostras=6,
+                                                                      executor=pool), args.repeticoes)
+        etapas[f'tabelas_correlacao_por_ano ({args.processos} proc.)'] = (t, m)
+        for chave, tabela in serie.items():
+            pd.testing.assert_frame_equal(tabela, paralelo[chave], check_exact=True)
+
+    for metodo in ['spearman', 'parcial']:
+        _, t, m = medir(lambda: calcular_correlacoes(df, indice, [VARIAVEIS_SOJA[0]], min_amostras=6,
+                                                     metodo=metodo), args.repeticoes)
+        etapas[f'calcular_correlacoes ({metodo})'] = (t, m)
+
+    variaveis = sorted(indice['Variável Climática'].unique())[:5]
+    _, t, m = medir(lambda: montar_heatmap_correlacoes(df, indice, VARIAVEIS_SOJA[0], variaveis),
+                    args.repeticoes)
+    etapas['heatmap'] = (t, m)
+
+    _, t, m = medir(lambda: montar_cubo_producao(df), args.repeticoes)
+    etapas['cubo_producao'] = (t, m)
+
+    coordenadas = municipios.rename(columns={'longitude': 'lon', 'latitude': 'lat'})
+
+    def preparar_mapa():
+        df_ano = df.loc[linhas_ano, ['codigo_ibge', 'Quantidade produzida (Toneladas)']]
+        df_mapa = coordenadas.merge(df_ano, on='codigo_ibge', how='inner')
+        return preparar_camada_mapa(df_mapa, 'Quantidade produzida (Toneladas)', 10000)
+
+    camada, t, m = medir(preparar_mapa, args.repeticoes)
+    etapas['mapa (pydeck)'] = (t, m)
+
+    # Serialização dos dados da ColumnLayer, como o deck faz ao enviar ao navegador
+    _, t, m = medir(lambda: json.dumps(compactar_camada_mapa(camada).to_dict(orient='records')),
+                    args.repeticoes)
+    etapas['mapa (JSON da camada)'] = (t, m)
+
+    _, t, m = medir(lambda: quadros_mapa(coordenadas, df, slice(None), 'Quantidade produzida (Toneladas)', 10000),
+                    args.repeticoes)
+    etapas['mapa (quadros de todos os anos)'] = (t, m)
+
+    def preparar_mapa_em_grade():
+        # Nível de detalhe afastado: municípios agregados em células de 50 km
+        df_ano = df.loc[linhas_ano, ['codigo_ibge', 'Quantidade produzida (Toneladas)']]
+        df_mapa = coordenadas.merge(df_ano, on='codigo_ibge', how='inner')
+        grade = agregar_mapa_em_grade(df_mapa, 50, metricas=['Quantidade produzida (Toneladas)'])
+        return preparar_camada_mapa(grade, 'Quantidade produzida (Toneladas)', 10000)
+
+    _, t, m = medir(preparar_mapa_em_grade, args.repeticoes)
+    etapas['mapa (grade 50 km)'] = (t, m)
+
+    indice_espacial, t, m = medir(lambda: IndiceEspacial(coordenadas), args.repeticoes)
+    etapas['indice_espacial (construção)'] = (t, m)
+
+    def consultas_espaciais():
+        # Um município central por consulta: raio, viewport e vizinhos mais próximos
+        for lat, lon in coordenadas[['lat', 'lon']].head(50).itertuples(index=False):
+            indice_espacial.no_raio(lat, lon, 100)
+            indice_espacial.na_caixa(lat - 1, lat + 1, lon - 1, lon + 1)
+            indice_espacial.mais_proximos(lat, lon, k=5)
+
+    _, t, m = medir(consultas_espaciais, args.repeticoes)
+    etapas['indice_espacial (50 × 3 consultas)'] = (t, m)
+
+    vizinhanca, t, m = medir(lambda: matriz_vizinhanca(df, indice_espacial, k=5), args.repeticoes)
+    etapas['matriz_vizinhanca (k=5)'] = (t, m)
+    _, t, m = medir(lambda: tabelas_correlacao_por_ano(df, indice, METRICAS_FOCO, min_amostras=6,
+                                                       vizinhanca=vizinhanca), args.repeticoes)
+    etapas['tabelas_correlacao_por_ano (suavizado k=5)'] = (t, m)
+
+    return {etapa: {'tempo_s': t, 'pico_mb': m} for etapa, (t, m) in etapas.items()}
+
+
+# ==========================================
+# LINHA DE BASE
+# ==========================================
+def nome_cenario(args):
+    return (f"mun={args.municipios} anos={args.anos} atrib={args.atributos}"
+            f" dec={'36x2' if args.decendios_completos else 'ciclo'}")
+
+
+def carregar_baseline():
+    if not os.path.exists(ARQUIVO_BASELINE):
+        return {}
+    with open(ARQUIVO_BASELINE, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def salvar_baseline(cenario, resultados):
+    baseline = carregar_baseline()
+    baseline[cenario] = {
+        'data': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'maquina': f"{platform.node()} / {platform.python_version()} / numpy {np.__version__} / pandas {pd.__version__}",
+        'etapas': resultados,
+    }
+    os.makedirs(os.path.dirname(ARQUIVO_BASELINE), exist_ok=True)
+    with open(ARQUIVO_BASELINE, 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, indent=2, ensure_ascii=False)
+
+
+def imprimir(resultados, referencia=None, tolerancia=0.2):
+    """Tabela por etapa; com `referencia`, mostra a variação e marca regressões."""
+    regressoes = []
+    print(f"{'Etapa':<34}{'Tempo (ms)':>12}{'Pico (MB)':>12}", end='')
+    print(f"{'Base (ms)':>12}{'Variação':>10}" if referencia else '')
+    for etapa, r in resultados.items():
+        linha = f"{etapa:<34}{r['tempo_s'] * 1000:>12.1f}{r['pico_mb']:>12.1f}"
+        base = (referencia or {}).get(etapa)
+        if base:
+            variacao = r['tempo_s'] / base['tempo_s'] - 1 if base['tempo_s'] > 0 else 0.0
+            marca = '  ⚠ regressão' if variacao > tolerancia else ''
+            if marca:
+                regressoes.append(etapa)
+            linha += f"{base['tempo_s'] * 1000:>12.1f}{variacao:>+10.0%}{marca}"
+        print(linha)
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--municipios', type=int, default=400)
+    parser.add_argument('--anos', type=int, default=7)
+    parser.add_argument('--atributos', type=int, default=10,
+                        help='atributos climáticos (cada um com todos os decêndios)')
+    parser.add_argument('--decendios-completos', action='store_true',
+                        help='36 decêndios em cada ano safra, em vez de só o ciclo da soja')
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--semente', type=int, default=0)
+    parser.add_argument('--processos', type=int, default=0,
+                        help='mede também o lote de correlações em paralelo (e confere o resultado com o serial)')
+    parser.add_argument('--salvar', action='store_true', help='grava o resultado como linha de base')
+    parser.add_argument('--comparar', action='store_true', help='compara com a linha de base do cenário')
+    parser.add_argument('--tolerancia', type=float, default=0.2,
+                        help='aumento relativo de tempo considerado regressão (padrão 0.2 = 20%%)')
+    args = parser.parse_args()
+
+    cenario = nome_cenario(args)
+    print(f"Cenário: {cenario} | repetições: {args.repeticoes}\n")
+    resultados = executar(args)
+
+    referencia = None
+    if args.comparar:
+        referencia = carregar_baseline().get(cenario, {}).get('etapas')
+        if referencia is None:
+            print("Sem linha de base para este cenário; use --salvar primeiro.\n")
+
+    regressoes = imprimir(resultados, referencia, args.tolerancia)
+
+    if args.salvar:
+        salvar_baseline(cenario, resultados)
+        print(f"\nLinha de base gravada em {ARQUIVO_BASELINE}")
+    if regressoes:
+        print(f"\n{len(regressoes)} etapa(s) acima da tolerância: {', '.join(regressoes)}")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+import pydeck as pdk
+from plotly.subplots import make_subplots
+from scipy import stats
+
+from analise import (
+    COLOR_RANGE,
+    compactar_camada_mapa,
+    faixas_legenda,
+    formatar_numero,
+    formatar_numeros,
+    formatar_p_valor,
+)
+
+# Fonte preta em títulos e marcações dos eixos
+FONTE_EIXOS = dict(tickfont=dict(color='black'), title_font=dict(color='black'))
+
+
+def nome_curto(metrica):
+    """Nome da métrica sem a unidade entre parênteses."""
+    return metrica.split('(')[0].strip()
+
+
+# ==========================================
+# PRODUÇÃO (SÉRIES ANUAIS)
+# ==========================================
+def grafico_area_perdas(df_agregado):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=df_agregado['ano'], y=df_agregado['Área plantada (Hectares)'],
+                             name='Plantada', line=dict(color='#2ecc71', width=3), mode='lines+markers'))
+    fig.add_trace(go.Scatter(x=df_agregado['ano'], y=df_agregado['Área colhida (Hectares)'],
+                             name='Colhida', line=dict(color='#27ae60', width=3), mode='lines+markers'))
+    fig.add_trace(go.Scatter(x=df_agregado['ano'], y=df_agregado['Área perdida (Hectares)'],
+                             name='Perdida', line=dict(color='#e74c3c', width=3), fill='tozeroy', mode='lines+markers'))
+    fig.update_layout(
+        title='<b>Evolução da Área e Perdas</b>',
+        xaxis_title='Ano', yaxis_title='Hectares', hovermode='x unified', height=450,
+        font=dict(color='black'),
+        separators=',.'  # CONFIGURAÇÃO PT-BR
+    )
+    fig.update_xaxes(type='category', **FONTE_EIXOS)
+    fig.update_yaxes(**FONTE_EIXOS)
+    return fig
+
+
+def grafico_producao_perda(df_agregado):
+    fig = make_subplots(specs=[[{"secondary_y": True}]])
+    fig.add_trace(go.Bar(x=df_agregado['ano'], y=df_agregado['Quantidade produzida (Toneladas)'],
+                         name='Produção', marker_color='#3498db'), secondary_y=False)
+    fig.add_trace(go.Scatter(x=df_agregado['ano'], y=df_agregado['Percentual de perda (%)'],
+                             name='% Perda', line=dict(color='#e74c3c', width=3), mode='lines+markers'), secondary_y=True)
+    fig.update_layout(
+        title='<b>Produção e Percentual de Perda</b>', hovermode='x unified', height=450,
+        font=dict(color='black'),
+        separators=',.' # CONFIGURAÇÃO PT-BR
+    )
+    fig.update_xaxes(title_text="Ano", type='category', **FONTE_EIXOS)
+    fig.update_yaxes(title_text="Quilograma", secondary_y=False, **FONTE_EIXOS)
+    fig.update_yaxes(title_text="% Perda", secondary_y=True, **FONTE_EIXOS)
+    return fig
+
+
+def grafico_rendimento(df_agregado):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=df_agregado['ano'], y=df_agregado['Rendimento médio da produção (Quilogramas por Hectare)'],
+                             mode='lines+markers', line=dict(color='#9b59b6', width=3), marker=dict(size=12)))
+    fig.update_layout(
+        title='<b>Rendimento Médio</b>', xaxis_title='Ano', yaxis_title='kg/ha', height=400,
+        font=dict(color='black'),
+        separators=',.' # CONFIGURAÇÃO PT-BR
+    )
+    fig.update_xaxes(type='category', **FONTE_EIXOS)
+    fig.update_yaxes(**FONTE_EIXOS)
+    return fig
+
+
+def grafico_valor(df_agregado):
+    # Formatando o texto das barras manualmente para R$ com vírgula
+    texto_valor = formatar_numeros(df_agregado['Valor da produção (Mil Reais)'], prefixo='R$ ')
+
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        x=df_agregado['ano'],
+        y=df_agregado['Valor da produção (Mil Reais)'],
+        marker_color='#16a085',
+        text=texto_valor,
+        textposition='outside'
+    ))
+    fig.update_layout(
+        title='<b>Valor da Produção</b>',
+        xaxis_title='Ano',
+        yaxis_title='Reais (R$)',
+        height=400,
+        yaxis=dict(range=[0, df_agregado['Valor da produção (Mil Reais)'].max() * 1.15]),
+        font=dict(color='black'),
+        separators=',.' # CONFIGURAÇÃO PT-BR
+    )
+    fig.update_xaxes(type='category', **FONTE_EIXOS)
+    fig.update_yaxes(**FONTE_EIXOS)
+    return fig
+
+
+def grafico_matriz_correlacao(corr_matrix):
+    # Criar uma matriz de texto com formatação PT-BR para o Heatmap
+    text_matrix = formatar_numeros(corr_matrix, decimais=2)
+
+    fig = px.imshow(
+        corr_matrix,
+        text_auto=False, # Desliga automático para usar nossa matriz formatada
+        aspect="auto",
+        color_continuous_scale='RdYlGn',
+        zmin=-1, zmax=1,
+        height=600
+    )
+
+    # Adicionar o texto manualmente
+    fig.update_traces(text=text_matrix, texttemplate="%{text}")
+
+    fig.update_layout(
+        title='<b>Matriz de Correlação de Pearson</b>',
+        font=dict(color='black'),
+        separators=',.'
+    )
+    fig.update_xaxes(tickfont=dict(color='black'))
+    fig.update_yaxes(tickfont=dict(color='black'))
+    return fig
+
+
+# ==========================================
+# VARIÁVEIS CLIMÁTICAS
+# ==========================================
+def grafico_top_correlacoes(df_corr_foco, metrica, titulo_ano, titulo_eixo='Correlação de Pearson'):
+    """Barras horizontais das correlações mais fortes com `metrica`."""
+    # Formatando texto para o gráfico de barras
+    texto_corr = formatar_numeros(df_corr_foco['Correlação'], decimais=3)
+
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        x=df_corr_foco['Correlação'],
+        y=df_corr_foco['Rótulo'],
+        orientation='h',
+        marker_color=df_corr_foco['Correlação'],
+        marker_colorscale='RdYlGn',
+        marker_cmin=-1,
+        marker_cmax=1,
+        text=texto_corr,
+        textposition='outside',
+        customdata=np.column_stack([
+            formatar_numeros(df_corr_foco['n']),
+            [formatar_p_valor(p) for p in df_corr_foco['p-valor FDR']],
+            formatar_numeros(df_corr_foco['IC inferior'], decimais=3),
+            formatar_numeros(df_corr_foco['IC superior'], decimais=3),
+        ]),
+        hovertemplate=('<b>%{y}</b><br>r = %{text}<br>n = %{customdata[0]}<br>'
+                       'p (FDR) = %{customdata[1]}<br>IC 95%: [%{customdata[2]}; %{customdata[3]}]'
+                       '<extra></extra>')
+    ))
+
+    fig.update_layout(
+        title=f'<b>Correlação com: {metrica} ({titulo_ano})</b>',
+        xaxis_title=titulo_eixo,
+        yaxis_title='Variável Climática',
+        height=max(400, len(df_corr_foco) * 30),
+        xaxis_range=[-1, 1],
+        font=dict(color='black'),
+        separators=',.' # CONFIGURAÇÃO PT-BR
+    )
+    fig.update_xaxes(**FONTE_EIXOS)
+    fig.update_yaxes(**FONTE_EIXOS)
+    fig.add_vline(x=0, line_dash="dash", line_color="#000000")
+    return fig
+
+
+def grafico_dispersao(df_scatter, coluna, metrica, variavel):
+    """Dispersão clima × métrica com reta de tendência.
+
+    Usa a trendline OLS do Plotly (statsmodels); sem ela, ajusta a reta com
+    `scipy.stats.linregress`.
+    """
+    titulo_scatter = f"Dispersão ({nome_curto(metrica)}) × ({variavel})"
+    argumentos = dict(
+        x=coluna,
+        y=metrica,
+        color='ano',
+        size='Quantidade produzida (Toneladas)',
+        hover_data=['Município'],
+        title=titulo_scatter
+    )
+
+    try:
+        fig = px.scatter(df_scatter, trendline='ols', **argumentos)
+    except Exception:
+        fig = px.scatter(df_scatter, **argumentos)
+
+        if len(df_scatter) > 1:
+            slope, intercept, r_value, p_value, std_err = stats.linregress(df_scatter[coluna], df_scatter[metrica])
+            line_x = np.array([df_scatter[coluna].min(), df_scatter[coluna].max()])
+            line_y = slope * line_x + intercept
+
+            fig.add_trace(go.Scatter(
+                x=line_x,
+                y=line_y,
+                mode='lines',
+                name='Tendência',
+                line=dict(color='red', dash='dash', width=2)
+            ))
+
+    fig.update_layout(
+        height=400,
+        font=dict(color='black'),
+        separators=',.' # CONFIGURAÇÃO PT-BR
+    )
+    fig.update_xaxes(**FONTE_EIXOS)
+    fig.update_yaxes(**FONTE_EIXOS)
+    return fig
+
+
+def grafico_heatmap(pivot_heatmap, metrica, titulo_ano):
+    """Mapa de calor variável × período do ciclo da safra."""
+    # Criar textos formatados para o heatmap
+    text_heatmap = formatar_numeros(pivot_heatmap, decimais=2)
+
+    fig = go.Figure(data=go.Heatmap(
+        z=pivot_heatmap.values,
+        x=pivot_heatmap.columns,
+        y=pivot_heatmap.index,
+        colorscale='RdYlGn',
+        zmid=0,
+        text=text_heatmap.values,
+        texttemplate='%{text}',
+        textfont={"size": 8},
+        colorbar=dict(title="Correlação"),
+        zmin=-1,
+        zmax=1
+    ))
+
+    fig.update_layout(
+        title=f'<b>Correlação ao longo do Ciclo da Safra: {nome_curto(metrica)} ({titulo_ano})</b>',
+        xaxis_title='Período (Ano1: Set-Dez | Ano2: Jan-Mai)',
+        yaxis_title='Variável Climática',
+        height=max(500, len(pivot_heatmap) * 70),
+        xaxis=dict(
+            tickangle=-45,
+            tickfont=dict(size=9, color='black'),
+            title_font=dict(color='black')
+        ),
+        yaxis=dict(
+            tickfont=dict(color='black'),
+            title_font=dict(color='black')
+        ),
+        font=dict(color='black'),
+        separators=',.'
+    )
+
+    # Divisão entre Ano 1 e Ano 2 do ciclo
+    fig.add_vline(x=10.5, line_dash="dash", line_color="white", line_width=2)
+    return fig
+
+
+# ==========================================
+# EVOLUÇÃO DOS MUNICÍPIOS
+# ==========================================
+def grafico_evolucao_municipios(evolucao, medida, municipios, titulo, yaxis_title, fator=1):
+    """Uma linha por município com a série anual de `medida` (pivot de `evolucao_por_municipio`)."""
+    fig = go.Figure()
+    for municipio in municipios:
+        serie_mun = evolucao[medida][municipio].dropna()
+        fig.add_trace(go.Scatter(
+            x=serie_mun.index,
+            y=serie_mun * fator if fator != 1 else serie_mun,
+            mode='lines+markers',
+            name=municipio,
+            line=dict(width=2),
+            marker=dict(size=8)
+        ))
+
+    fig.update_layout(
+        title=titulo,
+        xaxis_title='Ano',
+        yaxis_title=yaxis_title,
+        height=500,
+        hovermode='x unified',
+        legend=dict(orientation="v", yanchor="top", y=1, xanchor="left", x=1.02),
+        font=dict(color='black'),
+        separators=',.' # CONFIGURAÇÃO PT-BR
+    )
+    fig.update_xaxes(type='linear', **FONTE_EIXOS)
+    fig.update_yaxes(**FONTE_EIXOS)
+    return fig
+
+
+# ==========================================
+# MAPA 3D
+# ==========================================
+def deck_mapa(df_mapa, metrica, column_width, elevation_scale, zoom=6.5, rotulo='Município'):
+    """Deck PyDeck com a ColumnLayer do mapa (DataFrame de `preparar_camada_mapa`).
+
+    Os dados vão pela forma compacta de `compactar_camada_mapa`. `rotulo` nomeia
+    a linha no tooltip (município ou célula da grade de `agregar_mapa_em_grade`).
+    """
+    centro = (df_mapa['lat'].mean(), df_mapa['lon'].mean())
+    return deck_camada(compactar_camada_mapa(df_mapa), metrica, column_width, elevation_scale, centro, zoom,
+                       rotulo)
+
+
+def deck_camada(camada, metrica, column_width, elevation_scale, centro, zoom=6.5, rotulo='Município'):
+    """Deck PyDeck de uma camada já compacta (`compactar_camada_mapa` ou um quadro de `quadros_mapa`).
+
+    `centro` é (latitude, longitude) da vista inicial.
+    """
+    column_layer = pdk.Layer(
+        "ColumnLayer",
+        data=camada,
+        get_position="p",
+        get_elevation="e",
+        elevation_scale=elevation_scale,
+        radius=column_width,
+        get_fill_color="c",
+        get_tooltip=['nome', 'v'],
+        pickable=True,
+        auto_highlight=True,
+        extruded=True,
+    )
+
+    # Centro do mapa
+    view_state = pdk.ViewState(
+        latitude=centro[0],
+        longitude=centro[1],
+        zoom=zoom,
+        pitch=50,
+        bearing=0
+    )
+
+    tooltip = {
+        "html": f"<b>{rotulo}:</b> {{nome}}<br/>"
+                f"<b>{nome_curto(metrica)}:</b> {{v}}",
+        "style": {
+            "backgroundColor": "steelblue",
+            "color": "white"
+        }
+    }
+
+    return pdk.Deck(
+        layers=[column_layer],
+        initial_view_state=view_state,
+        tooltip=tooltip
+    )
+
+
+def legenda_mapa_html(valores, metrica, color_range=COLOR_RANGE):
+    """HTML da legenda de cores do mapa, da faixa mais alta para a mais baixa."""
+    min_val, limites = faixas_legenda(valores, len(color_range))
+
+    legend_html = f"<b>{nome_curto(metrica)}:</b>"
+    legend_html += "<div style='display: flex; flex-direction: column;'>"
+
+    for color_index in reversed(range(len(color_range))):
+        color = color_range[color_index]
+        css_color = f"rgb({color[0]}, {color[1]}, {color[2]})"
+
+        # Formatação PT-BR na legenda
+        upper_bound_fmt = formatar_numero(limites[color_index], decimais=2)
+
+        legend_html += f"<div style='display: flex; align-items: center; margin-bottom: 3px;'><br/><div style='width: 20px; height: 10px; background-color: {css_color}; margin-right: 10px; border: 1px solid #333;'></div><br/><span>{upper_bound_fmt} (Máx)</span></div>"
+
+    min_val_fmt = formatar_numero(min_val, decimais=2)
+    legend_html += f"""
+                <div style='margin-top: 5px; text-align: left;'>
+                    <span>{min_val_fmt} (Min)</span>
+                </div>
+            </div>"""
+    return legend_html
@@ -0,0 +1,86 @@
+import json
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+# ==========================================
+# TEMPOS POR ETAPA (PERFIL DA SESSÃO)
+# ==========================================
+class Perfil:
+    """Registro dos tempos de cada etapa nomeada de uma sessão do dashboard.
+
+    Cada registro guarda a execução (rerun) em que ocorreu, o nome da etapa, o
+    instante de início, a duração em ms e, quando informados, o resultado do
+    cache (`hit`/`miss`), o tamanho do payload em bytes e outros extras. Não
+    depende do Streamlit: a página guarda uma instância por sessão.
+    """
+
+    def __init__(self, limite=5000):
+        self.registros = []
+        self.execucao = 0
+        self.limite = limite
+        self._abertas = []
+
+    def nova_execucao(self):
+        self.execucao += 1
+
+    @contextmanager
+    def etapa(self, nome, cache=False, **extras):
+        """Cronometra o bloco como a etapa `nome` e devolve o registro (editável).
+
+        Com `cache=True` o registro começa como `hit`; a função em cache chama
+        `marcar_miss` quando seu corpo de fato executa.
+        """
+        registro = {'execucao': self.execucao, 'etapa': nome, 'inicio': time.time(), **extras}
+        if cache:
+            registro['cache'] = 'hit'
+        self._abertas.append(registro)
+        inicio = time.perf_counter()
+        try:
+            yield registro
+        finally:
+            registro['duracao_ms'] = (time.perf_counter() - inicio) * 1000
+            self._abertas.remove(registro)
+            self.registros.append(registro)
+            del self.registros[:-self.limite]
+
+    def marcar_miss(self):
+        """Marca como `miss` a etapa em cache aberta mais interna."""
+        for registro in reversed(self._abertas):
+            if 'cache' in registro:
+                registro['cache'] = 'miss'
+                return
+
+    def tabela(self, execucao=None):
+        """Registros como DataFrame (todos ou só os de uma execução)."""
+        registros = self.registros
+        if execucao is not None:
+            registros = [r for r in registros if r['execucao'] == execucao]
+        tabela = pd.DataFrame(registros)
+        for coluna in ['cache', 'bytes']:
+            if coluna not in tabela:
+                tabela[coluna] = pd.Series(dtype=object if coluna == 'cache' else float)
+        return tabela
+
+    def resumo(self):
+        """Por etapa: chamadas, tempo total/médio/máximo, hits e misses de cache e bytes médios."""
+        tabela = self.tabela()
+        if len(tabela) == 0:
+            return tabela
+        grupos = tabela.groupby('etapa', sort=False)
+        resumo = pd.DataFrame({
+            'chamadas': grupos.size(),
+            'total_ms': grupos['duracao_ms'].sum(),
+            'medio_ms': grupos['duracao_ms'].mean(),
+            'max_ms': grupos['duracao_ms'].max(),
+            'hits': grupos['cache'].agg(lambda c: (c == 'hit').sum()),
+            'misses': grupos['cache'].agg(lambda c: (c == 'miss').sum()),
+            'bytes_medio': grupos['bytes'].mean(),
+        })
+        return resumo.sort_values('total_ms', ascending=False).reset_index()
+
+    def jsonl(self):
+        """Todos os registros em JSON lines, para análise offline."""
+        return ''.join(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in self.registros)
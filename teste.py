@@ -1,32 +1,61 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
 import streamlit as st
 import pandas as pd
-import plotly.graph_objects as go
-import plotly.express as px
-from plotly.subplots import make_subplots
-import numpy as np
-import re
-from scipy import stats
-import pydeck as pdk
-
-# ==========================================
-# FUNÇÃO AUXILIAR DE FORMATAÇÃO PT-BR
-# ==========================================
-def formatar_numero(valor, prefixo='', sufixo='', decimais=0):
-    """Formata números para o padrão brasileiro (1.000,00)."""
-    if pd.isna(valor):
-        return "-"
-    
-    # Formata primeiro no padrão americano para garantir a precisão
-    if decimais > 0:
-        s = f"{valor:,.{decimais}f}"
-    else:
-        s = f"{valor:,.0f}"
-    
-    # Inverte os caracteres: vírgula vira X, ponto vira vírgula, X vira ponto
-    # Ex: 1,234.56 -> 1X234.56 -> 1X234,56 -> 1.234,56
-    s = s.replace(',', 'X').replace('.', ',').replace('X', '.')
-    
-    return f"{prefixo}{s}{sufixo}".strip()
+
+from analise import (
+    COLOR_RANGE,
+    IndiceEspacial,
+    METODOS_CORRELACAO,
+    METRICAS_FOCO,
+    METRICAS_MAPA,
+    MEDIDAS_RANKING,
+    abrir_dados_sob_demanda,
+    agregar_mapa_em_grade,
+    agregar_por_ano,
+    criar_pool_correlacoes,
+    evolucao_por_municipio,
+    formatar_numero,
+    formatar_numeros,
+    formatar_p_valor,
+    heatmap_da_tabela,
+    impressao_filtro,
+    lado_celula_para_zoom,
+    mascara_recorte,
+    matriz_correlacao_producao,
+    media_por_municipio,
+    medias_por_fase,
+    montar_cubo_producao,
+    montar_dados_mapa,
+    matriz_vizinhanca,
+    preparar_camada_mapa,
+    preparar_municipios,
+    quadros_mapa,
+    recortar_cubo,
+    tabelas_correlacao_por_ano,
+    variacoes_ultimo_ano,
+)
+from graficos import (
+    deck_camada,
+    deck_mapa,
+    grafico_area_perdas,
+    grafico_dispersao,
+    grafico_evolucao_municipios,
+    grafico_heatmap,
+    grafico_matriz_correlacao,
+    grafico_producao_perda,
+    grafico_rendimento,
+    grafico_top_correlacoes,
+    grafico_valor,
+    legenda_mapa_html,
+    nome_curto,
+)
+from perfil import Perfil
 
 # Configuração da página
 st.set_page_config(
@@ -62,30 +91,25 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
+# Perfil de desempenho da sessão: um registro por etapa, a cada rerun
+if 'perfil' not in st.session_state:
+    st.session_state['perfil'] = Perfil()
+perfil = st.session_state['perfil']
+perfil.nova_execucao()
+
 # Título
 st.markdown("<h1>🌱 Dashboard - Soja no Paraná (2018-2024)</h1>", unsafe_allow_html=True)
 st.markdown("<h3 style='text-align: center; color: #000000;'>Análise Inteligente: Clima + Produtividade + Geolocalização</h3>", unsafe_allow_html=True)
 
-# Carregar dados
-@st.cache_data
+# Carregar dados: produção em memória e colunas climáticas sob demanda, por atributo
+# (cache_resource: um único armazém por processo, compartilhado entre as sessões)
+@st.cache_resource
 def carregar_dados():
+    perfil.marcar_miss()
     try:
         # Tente usar o nome exato do seu arquivo ou ajuste aqui
-        df = pd.read_csv('PAM_SIDRA_NASAPOWER_FENOLOGIA_SOJA_PR_Copia.csv')
-        
-        # Calcular área perdida
-        df['Área perdida (Hectares)'] = df['Área plantada (Hectares)'] - df['Área colhida (Hectares)']
-        df['Percentual de perda (%)'] = (df['Área perdida (Hectares)'] / df['Área plantada (Hectares)']) * 100
-        
-        # Converter valores de mil para valores reais
-        df['Quantidade produzida (Toneladas)'] = df['Quantidade produzida (Toneladas)'] * 1000
-        df['Valor da produção (Mil Reais)'] = df['Valor da produção (Mil Reais)'] * 1000
-        
-        # Renomear coluna para merge
-        df = df.rename(columns={'Código IBGE': 'codigo_ibge'})
-        df['codigo_ibge'] = df['codigo_ibge'].astype(str).str.zfill(7).str[:7].astype(int)
-        
-        return df
+        # (cache colunar em .cache_dados/ evita reprocessar o CSV a cada novo processo)
+        return abrir_dados_sob_demanda('PAM_SIDRA_NASAPOWER_FENOLOGIA_SOJA_PR_Copia.csv')
     except FileNotFoundError:
         st.error("⚠️ Erro: Arquivo 'PAM_SIDRA_NASAPOWER_FENOLOGIA_SOJA_PR_Copia.csv' não encontrado!")
         st.stop()
@@ -93,14 +117,12 @@ def carregar_dados():
         st.error(f"❌ Erro ao carregar dados: {e}")
         st.stop()
 
+# Municípios de todas as UFs: o merge do mapa mantém só os que estão na base
 @st.cache_data
 def carregar_municipios():
+    perfil.marcar_miss()
     try:
-        df_municipios = pd.read_csv('municipios.csv')
-        df_parana = df_municipios[df_municipios['codigo_uf'] == 41].copy()
-        df_parana = df_parana.rename(columns={'longitude': 'lon', 'latitude': 'lat'})
-        df_parana['codigo_ibge'] = df_parana['codigo_ibge'].astype(str).str.zfill(7).str[:7].astype(int)
-        return df_parana
+        return preparar_municipios(pd.read_csv('municipios.csv'), codigo_uf=None)
     except FileNotFoundError:
         st.warning("⚠️ Arquivo 'municipios.csv' não encontrado. Mapa 3D não disponível.")
         return None
@@ -108,53 +130,34 @@ def carregar_municipios():
         st.warning(f"⚠️ Erro ao carregar municípios: {e}")
         return None
 
-df = carregar_dados()
-df_municipios = carregar_municipios()
+with perfil.etapa('carregar_dados', cache=True):
+    df, indice_climatico, clima = carregar_dados()
+with perfil.etapa('carregar_municipios', cache=True):
+    df_municipios = carregar_municipios()
+
+# KD-tree sobre as coordenadas, construída uma vez ao lado da tabela de municípios
+@st.cache_resource
+def carregar_indice_espacial(_df_municipios):
+    perfil.marcar_miss()
+    return IndiceEspacial(_df_municipios)
+
+indice_espacial = None
+if df_municipios is not None:
+    with perfil.etapa('carregar_indice_espacial', cache=True):
+        indice_espacial = carregar_indice_espacial(df_municipios)
 
-# Identificar colunas climáticas
-colunas_climaticas = [col for col in df.columns if re.match(r'.*_dec\d+_ano\d+', col)]
-atributos_climaticos = list(set([col.rsplit('_dec', 1)[0] for col in colunas_climaticas]))
+# Índice das colunas climáticas: (atributo, decêndio, ano safra) → coluna no cache
+colunas_climaticas = indice_climatico['Coluna'].tolist()
 
-# Função para calcular correlações com variáveis de soja
+# Código IBGE de cada município, usado nas chaves de cache dos recortes
+codigos_por_municipio = df.drop_duplicates('Município').set_index('Município')['codigo_ibge']
+chave_dados = impressao_filtro(df['ano'].unique(), codigos_por_municipio)
+
+# Cubo ano × município com as medidas de produção, montado uma vez por base
 @st.cache_data
-def calcular_correlacoes_relevantes(_df):
-    variaveis_soja = [
-        'Rendimento médio da produção (Quilogramas por Hectare)',
-        'Quantidade produzida (Toneladas)',
-        'Área perdida (Hectares)',
-        'Percentual de perda (%)'
-    ]
-    
-    resultados = []
-    
-    for var_soja in variaveis_soja:
-        for col_clima in colunas_climaticas:
-            try:
-                df_temp = _df[[col_clima, var_soja]].dropna()
-                if len(df_temp) > 0:
-                    corr = df_temp.corr().iloc[0, 1]
-                    if not np.isnan(corr):
-                        atributo = col_clima.rsplit('_dec', 1)[0]
-                        dec_match = re.search(r'dec(\d+)', col_clima)
-                        ano_match = re.search(r'ano(\d+)', col_clima)
-                        
-                        if dec_match and ano_match:
-                            resultados.append({
-                                'Variável Climática': atributo,
-                                'Decêndio': int(dec_match.group(1)),
-                                'Ano Safra': f"ano{ano_match.group(1)}",
-                                'Coluna': col_clima,
-                                'Variável Soja': var_soja,
-                                'Correlação': corr,
-                                'Correlação Abs': abs(corr)
-                            })
-            except:
-                continue
-    
-    return pd.DataFrame(resultados)
-
-with st.spinner("🔍 Analisando correlações climáticas..."):
-    df_correlacoes_inicial = calcular_correlacoes_relevantes(df)
+def carregar_cubo_producao(_df, chave_filtro):
+    perfil.marcar_miss()
+    return montar_cubo_producao(_df)
 
 # Sidebar - Filtros
 st.sidebar.header("🔍 Filtros de Análise")
@@ -169,14 +172,28 @@ anos_selecionados = st.sidebar.multiselect(
 
 # Filtro de Municípios
 municipios_disponiveis = sorted(df['Município'].unique())
+opcoes_municipios = ["Todos os municípios", "Selecionar específicos"]
+if indice_espacial is not None:
+    opcoes_municipios.append("Raio em torno de um município")
 visualizar_todos = st.sidebar.radio(
     "Municípios:",
-    options=["Todos os municípios", "Selecionar específicos"],
+    options=opcoes_municipios,
     index=0
 )
 
 if visualizar_todos == "Todos os municípios":
     municipios_selecionados = municipios_disponiveis
+elif visualizar_todos == "Raio em torno de um município":
+    municipio_central = st.sidebar.selectbox("Município central:", options=municipios_disponiveis)
+    raio_km = st.sidebar.slider("Raio (km):", min_value=10, max_value=500, value=100, step=10)
+    try:
+        vizinhos = indice_espacial.vizinhos_do_municipio(codigos_por_municipio[municipio_central], raio_km)
+    except KeyError:
+        st.sidebar.warning("⚠️ Município sem coordenadas em 'municipios.csv'.")
+        vizinhos = indice_espacial.municipios.iloc[:0]
+    codigos_vizinhos = set(vizinhos['codigo_ibge'])
+    municipios_selecionados = [m for m in municipios_disponiveis if codigos_por_municipio[m] in codigos_vizinhos]
+    st.sidebar.caption(f"{len(municipios_selecionados)} municípios a até {raio_km} km de {municipio_central}")
 else:
     municipios_selecionados = st.sidebar.multiselect(
         "Escolha os municípios:",
@@ -184,30 +201,31 @@ else:
         default=municipios_disponiveis[:5] if len(municipios_disponiveis) >= 5 else municipios_disponiveis
     )
 
-# Aplicar filtros
-df_filtrado = df[
-    (df['ano'].isin(anos_selecionados)) & 
-    (df['Município'].isin(municipios_selecionados))
-].copy()
+# Aplicar filtros: só a máscara de linhas; cada seção extrai apenas as colunas que usa
+mascara_filtro = mascara_recorte(df, anos_selecionados, municipios_selecionados)
+
+# Impressão digital do recorte: entra na chave de todas as análises em cache
+chave_filtro = impressao_filtro(anos_selecionados, codigos_por_municipio.loc[municipios_selecionados])
+
+# Recorte do cubo ano × município (indicadores e rankings)
+with perfil.etapa('carregar_cubo_producao', cache=True):
+    cubo_producao = carregar_cubo_producao(df, chave_dados)
+cubo_filtrado = recortar_cubo(cubo_producao, anos_selecionados, municipios_selecionados)
 
 # Informações
 st.sidebar.markdown("---")
 st.sidebar.header("📊 Informações")
 st.sidebar.metric("Municípios", len(municipios_selecionados))
 st.sidebar.metric("Anos", len(anos_selecionados))
-st.sidebar.metric("Registros", formatar_numero(len(df_filtrado)))
+st.sidebar.metric("Registros", formatar_numero(cubo_filtrado['Registros'].sum()))
 st.sidebar.metric("Variáveis Climáticas", len(colunas_climaticas))
 
+# Painel de desempenho (tempos por etapa, cache e payloads); desenhado no fim da página
+st.sidebar.markdown("---")
+painel_desempenho = st.sidebar.toggle("⏱️ Painel de desempenho", value=False, key='painel_desempenho')
+
 # Agregação por ano
-df_agregado = df_filtrado.groupby('ano').agg({
-    'Área plantada (Hectares)': 'sum',
-    'Área colhida (Hectares)': 'sum',
-    'Área perdida (Hectares)': 'sum',
-    'Percentual de perda (%)': 'mean',
-    'Quantidade produzida (Toneladas)': 'sum',
-    'Valor da produção (Mil Reais)': 'sum',
-    'Rendimento médio da produção (Quilogramas por Hectare)': 'mean'
-}).reset_index()
+df_agregado = agregar_por_ano(cubo_filtrado)
 
 # ===========================
 # MÉTRICAS PRINCIPAIS
@@ -215,850 +233,696 @@ df_agregado = df_filtrado.groupby('ano').agg({
 st.header("📊 Indicadores Principais – Paraná (Último Ano)")
 st.info("📋 Resumo dos principais indicadores de produção e rendimento de soja no último ano agrícola.")
 
+def formatar_variacao(valor, sufixo='%'):
+    return formatar_numero(valor, sufixo=sufixo, decimais=2, prefixo='+ ' if valor > 0 else '')
+
 if len(df_agregado) > 0:
-    ultimo_ano = df_agregado.iloc[-1]
-    penultimo_ano = df_agregado.iloc[-2] if len(df_agregado) > 1 else ultimo_ano
-    
+    ultimo_ano, variacoes = variacoes_ultimo_ano(df_agregado)
+
     col1, col2, col3, col4, col5 = st.columns(5)
-    
+
     with col1:
-        area_var = ((ultimo_ano['Área plantada (Hectares)'] - penultimo_ano['Área plantada (Hectares)']) / penultimo_ano['Área plantada (Hectares)'] * 100) if penultimo_ano['Área plantada (Hectares)'] > 0 else 0
         st.metric(
-            "Área Plantada", 
-            formatar_numero(ultimo_ano['Área plantada (Hectares)'], sufixo=' ha'), 
-            formatar_numero(area_var, sufixo='%', decimais=2, prefixo='+ ' if area_var > 0 else '')
+            "Área Plantada",
+            formatar_numero(ultimo_ano['Área plantada (Hectares)'], sufixo=' ha'),
+            formatar_variacao(variacoes['Área plantada (Hectares)'])
         )
-    
+
     with col2:
-        perda_var = ((ultimo_ano['Área perdida (Hectares)'] - penultimo_ano['Área perdida (Hectares)']) / penultimo_ano['Área perdida (Hectares)'] * 100) if penultimo_ano['Área perdida (Hectares)'] > 0 else 0
         st.metric(
-            "Área Perdida", 
-            formatar_numero(ultimo_ano['Área perdida (Hectares)'], sufixo=' ha'), 
-            formatar_numero(perda_var, sufixo='%', decimais=2, prefixo='+ ' if perda_var > 0 else ''),
+            "Área Perdida",
+            formatar_numero(ultimo_ano['Área perdida (Hectares)'], sufixo=' ha'),
+            formatar_variacao(variacoes['Área perdida (Hectares)']),
             delta_color="inverse"
         )
-    
+
     with col3:
-        prod_var = ((ultimo_ano['Quantidade produzida (Toneladas)'] - penultimo_ano['Quantidade produzida (Toneladas)']) / penultimo_ano['Quantidade produzida (Toneladas)'] * 100) if penultimo_ano['Quantidade produzida (Toneladas)'] > 0 else 0
         st.metric(
-            "Produção", 
-            formatar_numero(ultimo_ano['Quantidade produzida (Toneladas)'], sufixo=' Kg'), 
-            formatar_numero(prod_var, sufixo='%', decimais=2, prefixo='+ ' if prod_var > 0 else '')
+            "Produção",
+            formatar_numero(ultimo_ano['Quantidade produzida (Toneladas)'], sufixo=' Kg'),
+            formatar_variacao(variacoes['Quantidade produzida (Toneladas)'])
         )
-    
+
     with col4:
-        rend_var = ((ultimo_ano['Rendimento médio da produção (Quilogramas por Hectare)'] - penultimo_ano['Rendimento médio da produção (Quilogramas por Hectare)']) / penultimo_ano['Rendimento médio da produção (Quilogramas por Hectare)'] * 100) if penultimo_ano['Rendimento médio da produção (Quilogramas por Hectare)'] > 0 else 0
         st.metric(
-            "Rendimento", 
-            formatar_numero(ultimo_ano['Rendimento médio da produção (Quilogramas por Hectare)'], sufixo=' kg/ha'), 
-            formatar_numero(rend_var, sufixo='%', decimais=2, prefixo='+ ' if rend_var > 0 else '')
+            "Rendimento",
+            formatar_numero(ultimo_ano['Rendimento médio da produção (Quilogramas por Hectare)'], sufixo=' kg/ha'),
+            formatar_variacao(variacoes['Rendimento médio da produção (Quilogramas por Hectare)'])
         )
-    
+
     with col5:
-        diff_perda = ultimo_ano['Percentual de perda (%)'] - penultimo_ano['Percentual de perda (%)']
         st.metric(
-            "% de Perda", 
-            formatar_numero(ultimo_ano['Percentual de perda (%)'], sufixo='%', decimais=2), 
-            formatar_numero(diff_perda, sufixo=' pp', decimais=2, prefixo='+ ' if diff_perda > 0 else ''),
+            "% de Perda",
+            formatar_numero(ultimo_ano['Percentual de perda (%)'], sufixo='%', decimais=2),
+            formatar_variacao(variacoes['Percentual de perda (%)'], sufixo=' pp'),
             delta_color="inverse"
         )
 
 # ===========================
-# MAPA 3D INTERATIVO
+# ANÁLISES CLIMÁTICAS EM CACHE
 # ===========================
-if df_municipios is not None:
-    st.header("🗺️ Mapa 3D – Distribuição Espacial da Produção")
-    st.info("📋 Visualização tridimensional da variáveis de produção de soja por município. A altura das colunas representa o volume")
-    
-    # Seleção de ano para o mapa
-    anos_mapa_disponiveis = sorted(df_filtrado['ano'].unique())
-    if len(anos_mapa_disponiveis) > 0:
-        ano_mapa = st.selectbox("Selecione o ano para visualização:", anos_mapa_disponiveis, 
-                                index=len(anos_mapa_disponiveis)-1, key='ano_mapa')
+# Executor de segundo plano, compartilhado pelas sessões; alguns lotes em paralelo para
+# que uma sessão não espere os lotes de todas as outras
+LOTES_SIMULTANEOS = min(4, os.cpu_count() or 1)
+
+@st.cache_resource
+def executor_segundo_plano():
+    return ThreadPoolExecutor(max_workers=LOTES_SIMULTANEOS, thread_name_prefix='correlacoes')
+
+# Sessões que esperam cada lote ainda não concluído: um lote só é cancelado quando
+# nenhuma sessão precisa mais dele
+@st.cache_resource
+def registro_lotes():
+    return threading.Lock(), {}
+
+# Modo paralelo opcional: com DASHBOARD_PROCESSOS > 1, os atributos climáticos do lote
+# são divididos entre processos (mesmo resultado do cálculo em série)
+PROCESSOS_CORRELACAO = int(os.environ.get('DASHBOARD_PROCESSOS', '0'))
+
+@st.cache_resource
+def pool_correlacoes():
+    if PROCESSOS_CORRELACAO > 1:
+        return criar_pool_correlacoes(PROCESSOS_CORRELACAO)
+    return None
+
+def calcular_tabelas_por_ano(df, linhas, metodo, vizinhanca, pool):
+    argumentos = dict(min_amostras=6, linhas=linhas, clima=clima, metodo=metodo, vizinhanca=vizinhanca)
+    try:
+        return tabelas_correlacao_por_ano(df, indice_climatico, METRICAS_FOCO, executor=pool, **argumentos)
+    except BrokenProcessPool:
+        # Um processo morreu (OOM, segfault): o pool é refeito no próximo lote e
+        # este segue em série, com o mesmo resultado
+        pool_correlacoes.clear()
+        pool.shutdown(wait=False, cancel_futures=True)
+        return tabelas_correlacao_por_ano(df, indice_climatico, METRICAS_FOCO, **argumentos)
+
+# Suavização espacial opcional: métricas e clima trocados pela média dos vizinhos no mesmo ano
+VIZINHANCAS = {
+    'nenhuma': ("Sem suavização", {}),
+    'k5': ("5 vizinhos mais próximos", {'k': 5}),
+    'k10': ("10 vizinhos mais próximos", {'k': 10}),
+    'r50': ("Raio de 50 km", {'raio_km': 50}),
+    'r100': ("Raio de 100 km", {'raio_km': 100}),
+}
+
+# Matriz esparsa de vizinhança das linhas do recorte
+@st.cache_resource(max_entries=8)
+def carregar_vizinhanca(_df, _linhas, chave_filtro, vizinhanca):
+    perfil.marcar_miss()
+    return matriz_vizinhanca(_df, indice_espacial, _linhas, **VIZINHANCAS[vizinhanca][1])
+
+# Tabelas de correlação (todos os anos e cada ano × métricas de foco) de um recorte e método,
+# calculadas em lote no executor; trocar o ano ou a métrica passa a ser só uma consulta
+@st.cache_resource(max_entries=16)
+def lote_tabelas_por_ano(_df, _linhas, chave_filtro, metodo, vizinhanca='nenhuma'):
+    matriz = None
+    if vizinhanca != 'nenhuma' and indice_espacial is not None:
+        matriz = carregar_vizinhanca(_df, _linhas, chave_filtro, vizinhanca)
+    futuro = executor_segundo_plano().submit(
+        calcular_tabelas_por_ano, _df, _linhas, metodo, matriz, pool_correlacoes()
+    )
+    futuro.add_done_callback(esquecer_lote)
+    return futuro
+
+def esquecer_lote(futuro):
+    trava, interessados = registro_lotes()
+    with trava:
+        interessados.pop(futuro, None)
+
+def agendar_tabelas_por_ano(_df, _linhas, chave_filtro, metodo, vizinhanca='nenhuma'):
+    """Lote do recorte atual da sessão; o lote anterior da sessão é cancelado se ainda estiver
+    na fila e nenhuma outra sessão o esperar.
+
+    Só a entrada do cache de um lote cancelado ou que falhou é descartada, e o
+    lote é agendado de novo.
+    """
+    argumentos = (_df, _linhas, chave_filtro, metodo, vizinhanca)
+    futuro = lote_tabelas_por_ano(*argumentos)
+    if futuro.cancelled() or (futuro.done() and futuro.exception() is not None):
+        lote_tabelas_por_ano.clear(*argumentos)
+        futuro = lote_tabelas_por_ano(*argumentos)
+
+    sessao = st.session_state.setdefault('id_sessao', uuid.uuid4().hex)
+    anterior = st.session_state.get('lote_correlacoes')
+    trava, interessados = registro_lotes()
+    with trava:
+        if not futuro.done():
+            interessados.setdefault(futuro, set()).add(sessao)
+        if anterior is not None and anterior is not futuro:
+            restantes = interessados.get(anterior)
+            if restantes is not None:
+                restantes.discard(sessao)
+                if not restantes:
+                    del interessados[anterior]
+                    anterior.cancel()
+    st.session_state['lote_correlacoes'] = futuro
+    return futuro
+
+# Dispara o lote do recorte atual já neste rerun, enquanto as demais seções são desenhadas
+agendar_tabelas_por_ano(df, mascara_filtro, chave_filtro, st.session_state.get('metodo_correlacao', 'pearson'),
+                        st.session_state.get('vizinhanca', 'nenhuma'))
+
+def mostrar_grafico(nome, construir, *args, **kwargs):
+    """Monta a figura com `construir` e envia com st.plotly_chart, registrando os tempos no perfil.
+
+    Com o painel de desempenho ligado, registra também o tamanho do JSON da figura.
+    """
+    with perfil.etapa(nome) as registro:
+        inicio = time.perf_counter()
+        fig = construir(*args, **kwargs)
+        registro['construcao_ms'] = (time.perf_counter() - inicio) * 1000
+        st.plotly_chart(fig, use_container_width=True)
+    if painel_desempenho:
+        registro['bytes'] = len(fig.to_json())
+
+# ===========================
+# SEÇÕES SOB DEMANDA
+# ===========================
+# Cada seção é um fragmento: mexer em um controle dela reexecuta só a própria
+# seção. As abas usam on_change="rerun", então só a aba aberta é calculada.
+
+# MAPA 3D INTERATIVO
+# Intervalo entre os quadros da animação do mapa (segundos)
+INTERVALO_ANIMACAO_MAPA = 1.0
+
+# Quadros (ano → camada compacta) de um recorte, métrica e altura máxima
+@st.cache_resource(max_entries=8)
+def carregar_quadros_mapa(_linhas, chave_filtro, metrica, elevation_max):
+    perfil.marcar_miss()
+    quadros, valores = quadros_mapa(df_municipios, df, _linhas, metrica, elevation_max, COLOR_RANGE)
+    presentes = df_municipios[df_municipios['codigo_ibge'].isin(df.loc[_linhas, 'codigo_ibge'])]
+    return quadros, valores, (presentes['lat'].mean(), presentes['lon'].mean())
+
+def desenhar_quadro_mapa(quadros, ano, metrica, column_width, elevation_scale, centro, zoom):
+    with perfil.etapa('deck_quadro_mapa') as registro:
+        deck = deck_camada(quadros[ano], metrica, column_width, elevation_scale, centro, zoom)
+    with perfil.etapa('st.pydeck_chart'):
+        st.pydeck_chart(deck)
+    if painel_desempenho:
+        registro['bytes'] = len(deck.to_json())
+
+# Reprodução: a cada intervalo, só troca o quadro (nada é recalculado)
+@st.fragment(run_every=INTERVALO_ANIMACAO_MAPA)
+def reproduzir_quadros_mapa(quadros, metrica, column_width, elevation_scale, centro, zoom):
+    anos = list(quadros)
+    atual = st.session_state.get('ano_animacao')
+    ano = anos[(anos.index(atual) + 1) % len(anos)] if atual in anos else anos[0]
+    st.session_state['ano_animacao'] = ano
+    st.markdown(f"**Ano: {ano}**")
+    desenhar_quadro_mapa(quadros, ano, metrica, column_width, elevation_scale, centro, zoom)
+
+def animacao_mapa(mascara_filtro):
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        metrica = st.selectbox("Métrica para visualização:", METRICAS_MAPA, key='metrica_animacao')
+    with col2:
+        column_width = st.slider("Largura das Colunas (metros)", 3000, 30000, 15000, 1000, key='largura_animacao')
+    with col3:
+        elevation_scale = st.slider("Escala de Elevação", 5, 50, 20, 5, key='escala_animacao')
+    elevation_max = st.slider("Altura Máxima", 5000, 20000, 10000, 1000, key='altura_animacao')
+    zoom = st.slider("Zoom inicial", 4.0, 9.0, 6.5, 0.5, key='zoom_animacao')
+
+    # Todos os anos de uma vez: elevação, cor e tooltip numa só passada vetorizada
+    with perfil.etapa('carregar_quadros_mapa', cache=True):
+        quadros, valores, centro = carregar_quadros_mapa(mascara_filtro, chave_filtro, metrica, elevation_max)
+    if not quadros:
+        st.warning("⚠️ Não há dados com coordenadas para animar nos filtros selecionados.")
+        return
+
+    st.caption("Cores e alturas na mesma escala para todos os anos.")
+    if st.toggle("▶️ Reproduzir", key='reproduzir_mapa'):
+        reproduzir_quadros_mapa(quadros, metrica, column_width, elevation_scale, centro, zoom)
+    else:
+        # O ano guardado pode ter saído do recorte (filtros alterados)
+        if st.session_state.get('ano_animacao') not in quadros:
+            st.session_state.pop('ano_animacao', None)
+        ano = st.select_slider("Ano:", options=list(quadros), key='ano_animacao')
+        desenhar_quadro_mapa(quadros, ano, metrica, column_width, elevation_scale, centro, zoom)
+
+    st.subheader("🎨 Legenda de Cores")
+    st.markdown(legenda_mapa_html(valores, metrica, COLOR_RANGE), unsafe_allow_html=True)
+
+@st.fragment
+def secao_mapa(mascara_filtro, cubo_filtrado):
+    if df_municipios is not None:
+        st.header("🗺️ Mapa 3D – Distribuição Espacial da Produção")
+        st.info("📋 Visualização tridimensional da variáveis de produção de soja por município. A altura das colunas representa o volume")
+
+        # Animação: todos os anos pré-calculados, a reprodução só troca de quadro
+        if st.toggle("🎞️ Animação ano a ano", key='animacao_mapa',
+                     help="Pré-calcula os quadros de todos os anos filtrados para a métrica escolhida"):
+            animacao_mapa(mascara_filtro)
+            return
+
+        # Seleção de ano para o mapa
+        anos_mapa_disponiveis = sorted(cubo_filtrado['ano'].unique())
+        if len(anos_mapa_disponiveis) > 0:
+            ano_mapa = st.selectbox("Selecione o ano para visualização:", anos_mapa_disponiveis,
+                                    index=len(anos_mapa_disponiveis)-1, key='ano_mapa')
+        else:
+            st.warning("Não há anos disponíveis nos filtros para o mapa.")
+            ano_mapa = None
+
+        if ano_mapa is not None:
+            # Coordenadas + métricas do ano (merge pelo código IBGE)
+            with perfil.etapa('montar_dados_mapa'):
+                df_mapa = montar_dados_mapa(df_municipios, df, mascara_filtro & (df['ano'] == ano_mapa).to_numpy())
+
+            if len(df_mapa) > 0:
+                # Seleção de métrica para visualização
+                col1, col2, col3 = st.columns(3)
+
+                with col1:
+                    metrica_mapa = st.selectbox(
+                        "Métrica para visualização:",
+                        METRICAS_MAPA,
+                        key='metrica_mapa'
+                    )
+
+                with col2:
+                    column_width = st.slider("Largura das Colunas (metros)", 3000, 30000, 15000, 1000)
+
+                with col3:
+                    elevation_scale = st.slider("Escala de Elevação", 5, 50, 20, 5)
+
+                # Controle de altura máxima
+                elevation_max = st.slider("Altura Máxima", 5000, 20000, 10000, 1000)
+
+                # Nível de detalhe: zoom inicial e grade de agregação (automática pelo zoom)
+                col1, col2 = st.columns(2)
+                with col1:
+                    zoom_mapa = st.slider("Zoom inicial", 4.0, 9.0, 6.5, 0.5, key='zoom_mapa')
+                with col2:
+                    detalhe_mapa = st.selectbox(
+                        "Nível de detalhe:",
+                        options=['auto', 'municipios', 25, 50, 100],
+                        format_func=lambda lado: ("Automático (pelo zoom)" if lado == 'auto' else
+                                                  "Municípios" if lado == 'municipios' else f"Grade de {lado} km"),
+                        key='detalhe_mapa',
+                        help="Em zooms afastados, os municípios são agregados em células da grade: "
+                             "menos colunas no navegador e um mapa mais leve"
+                    )
+                if detalhe_mapa == 'auto':
+                    lado_km = lado_celula_para_zoom(zoom_mapa, len(df_mapa))
+                else:
+                    lado_km = None if detalhe_mapa == 'municipios' else detalhe_mapa
+
+                # Preparar dados para PyDeck (valor, tooltip formatado, elevação e cor)
+                with perfil.etapa('preparar_camada_mapa'):
+                    df_camada = df_mapa if lado_km is None else agregar_mapa_em_grade(df_mapa, lado_km)
+                    df_camada = preparar_camada_mapa(df_camada, metrica_mapa, elevation_max, COLOR_RANGE)
+
+                # Renderizar mapa (células: colunas com largura proporcional ao lado da célula)
+                with perfil.etapa('deck_mapa') as registro:
+                    if lado_km is None:
+                        deck = deck_mapa(df_camada, metrica_mapa, column_width, elevation_scale, zoom_mapa)
+                    else:
+                        deck = deck_mapa(df_camada, metrica_mapa, max(column_width, lado_km * 400),
+                                         elevation_scale, zoom_mapa, rotulo='Região')
+                with perfil.etapa('st.pydeck_chart'):
+                    st.pydeck_chart(deck)
+                if painel_desempenho:
+                    registro['bytes'] = len(deck.to_json())
+                if lado_km is not None:
+                    st.caption(f"{formatar_numero(len(df_camada))} células de ~{lado_km} km com "
+                               f"{formatar_numero(len(df_mapa))} municípios")
+
+                # Legenda de Cores
+                st.subheader("🎨 Legenda de Cores")
+                st.markdown(legenda_mapa_html(df_camada['metrica_viz'], metrica_mapa, COLOR_RANGE), unsafe_allow_html=True)
+
+                # Estatísticas do mapa
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    st.metric("Municípios no Mapa", len(df_mapa))
+                with col2:
+                    st.metric(f"Média - {nome_curto(metrica_mapa)}", formatar_numero(df_mapa[metrica_mapa].mean()))
+                with col3:
+                    st.metric("Máximo", formatar_numero(df_mapa[metrica_mapa].max()))
+                with col4:
+                    st.metric("Mínimo", formatar_numero(df_mapa[metrica_mapa].min()))
+
+                # Top 10 municípios no mapa
+                with st.expander("🏆 Top 10 Municípios - Visualização Detalhada"):
+                    top_10_mapa = df_mapa.nlargest(10, metrica_mapa)[['nome', metrica_mapa]].copy()
+                    # Aplicar formatação visual para a tabela
+                    top_10_mapa[metrica_mapa] = formatar_numeros(top_10_mapa[metrica_mapa], decimais=2)
+                    st.dataframe(top_10_mapa, hide_index=True, use_container_width=True)
+            else:
+                st.warning("⚠️ Não foi possível fazer o merge dos dados geográficos para o ano selecionado.")
+        else:
+            st.info("ℹ️ Selecione um ano disponível nos filtros para exibir o mapa.")
+    else:
+        st.info("ℹ️ Mapa 3D não disponível - arquivo 'municipios.csv' não encontrado.")
+
+
+# GRÁFICOS PRINCIPAIS E MATRIZ DE CORRELAÇÃO
+@st.fragment
+def secao_producao(df_agregado, mascara_filtro):
+    st.header("📈Análise Produtiva")
+    st.info("📈 Avaliação temporal da evolução da área cultivada, perdas percentuais e variação da produtividade.")
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        mostrar_grafico('grafico_area_perdas', grafico_area_perdas, df_agregado)
+
+    with col2:
+        mostrar_grafico('grafico_producao_perda', grafico_producao_perda, df_agregado)
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        mostrar_grafico('grafico_rendimento', grafico_rendimento, df_agregado)
+
+    with col2:
+        mostrar_grafico('grafico_valor', grafico_valor, df_agregado)
+
+    # Matriz de correlação
+    st.header("🔗 Matriz de Correlação (Variáveis de Produção)")
+    st.info("📊 Correlação de Pearson entre as variáveis de área, produção, rendimento e valor.")
+
+    corr_matrix = matriz_correlacao_producao(df, mascara_filtro)
+
+    if corr_matrix is not None:
+        mostrar_grafico('grafico_matriz_correlacao', grafico_matriz_correlacao, corr_matrix)
     else:
-        st.warning("Não há anos disponíveis nos filtros para o mapa.")
-        ano_mapa = None
-
-    if ano_mapa is not None:
-        # Preparar dados para o mapa
-        df_ano_mapa = df_filtrado[df_filtrado['ano'] == ano_mapa].copy()
-        
-        # Fazer o merge usando codigo_ibge
-        df_mapa = df_municipios.merge(
-            df_ano_mapa,
-            on='codigo_ibge',
-            how='inner'
+        st.warning("Colunas insuficientes encontradas no arquivo para gerar a matriz de correlação completa.")
+
+
+# VARIÁVEIS CLIMÁTICAS MAIS RELEVANTES E MAPA DE CALOR
+@st.fragment
+def secao_clima(mascara_filtro, chave_filtro, anos_selecionados):
+    st.header("🌤️ Variáveis Climáticas Mais Relevantes")
+
+    st.info("📋 **Análise automática:** Identificando as variáveis climáticas com maior correlação com rendimento, produção e perdas.")
+
+    # Filtros principais
+    col1, col2, col3, col4 = st.columns(4)
+
+    with col1:
+        top_n = st.slider("Número de variáveis mais relevantes:", 5, 20, 10)
+
+    with col2:
+        metrica_foco = st.selectbox("Foco da análise:", METRICAS_FOCO)
+
+    with col3:
+        ano_clima_analise = st.selectbox(
+            "Ano para análise:",
+            options=["Todos os anos"] + [str(ano) for ano in sorted(anos_selecionados)],
+            index=0
         )
-        
-        if len(df_mapa) > 0:
-            # Seleção de métrica para visualização
-            col1, col2, col3 = st.columns(3)
-            
+
+    with col4:
+        # Limite para o p-valor ajustado por FDR (Benjamini-Hochberg)
+        limite_fdr = st.selectbox(
+            "Significância (FDR):",
+            options=[None, 0.10, 0.05, 0.01],
+            format_func=lambda q: "Sem filtro" if q is None else f"q ≤ {formatar_numero(q, decimais=2)}",
+            help="Mantém só as correlações com p-valor ajustado por FDR (Benjamini-Hochberg) até o limite"
+        )
+
+    metodo_correlacao = st.radio(
+        "Método de correlação:",
+        options=list(METODOS_CORRELACAO),
+        format_func=METODOS_CORRELACAO.get,
+        horizontal=True,
+        key='metodo_correlacao',
+        help="Postos: Pearson sobre os postos de cada variável no recorte (relações monótonas, não só "
+             "lineares); aproxima o Spearman quando há dados faltantes. "
+             "A parcial remove a tendência linear entre os anos de cada variável"
+    )
+    parcial_em_um_ano = metodo_correlacao == 'parcial' and ano_clima_analise != "Todos os anos"
+    if metodo_correlacao == 'pearson' or parcial_em_um_ano:
+        titulo_eixo = 'Correlação de Pearson'
+    else:
+        titulo_eixo = f"Correlação – {METODOS_CORRELACAO[metodo_correlacao]}"
+    if parcial_em_um_ano:
+        st.caption("Em um único ano o ano não varia: a correlação parcial é igual à de Pearson.")
+
+    if indice_espacial is not None:
+        vizinhanca = st.radio(
+            "Suavização espacial:",
+            options=list(VIZINHANCAS),
+            format_func=lambda chave: VIZINHANCAS[chave][0],
+            horizontal=True,
+            key='vizinhanca',
+            help="Correlaciona a média de cada município com os vizinhos (no mesmo ano), "
+                 "reduzindo o ruído da produtividade municipal e da grade do NASA POWER"
+        )
+    else:
+        vizinhanca = 'nenhuma'
+
+    # Filtrar dados por ano se necessário (máscara sobre o DataFrame completo)
+    if ano_clima_analise == "Todos os anos":
+        mascara_correlacao = mascara_filtro
+        titulo_ano = "Todos os Anos"
+    else:
+        mascara_correlacao = mascara_filtro & (df['ano'] == int(ano_clima_analise)).to_numpy()
+        titulo_ano = ano_clima_analise
+
+    # Tabelas pré-calculadas do recorte: só espera se o lote ainda estiver em andamento
+    tabelas_futuro = agendar_tabelas_por_ano(df, mascara_filtro, chave_filtro, metodo_correlacao, vizinhanca)
+    with perfil.etapa('tabelas_correlacao_por_ano', cache=True):
+        if not tabelas_futuro.done():
+            perfil.marcar_miss()
+        with st.spinner("🔍 Calculando correlações por ano..."):
+            try:
+                try:
+                    tabelas_por_ano = tabelas_futuro.result()
+                except CancelledError:
+                    # Lote compartilhado cancelado por outra sessão: agenda de novo
+                    tabelas_futuro = agendar_tabelas_por_ano(df, mascara_filtro, chave_filtro, metodo_correlacao,
+                                                             vizinhanca)
+                    tabelas_por_ano = tabelas_futuro.result()
+            except Exception as e:
+                # O lote com falha sai do cache no próximo agendamento
+                st.error(f"❌ Erro ao calcular correlações: {e}")
+                return
+
+    ano_tabela = None if ano_clima_analise == "Todos os anos" else int(ano_clima_analise)
+    tabela_ano = tabelas_por_ano.get((ano_tabela, metrica_foco), pd.DataFrame())
+    df_corr_foco = tabela_ano
+
+    if len(df_corr_foco) == 0:
+        st.warning("⚠️ Não há dados suficientes para calcular correlações com os filtros selecionados.")
+        return
+
+    if limite_fdr is not None:
+        df_corr_foco = df_corr_foco[df_corr_foco['p-valor FDR'] <= limite_fdr]
+        if len(df_corr_foco) == 0:
+            st.warning(f"⚠️ Nenhuma correlação significativa com FDR ≤ {formatar_numero(limite_fdr, decimais=2)} para os filtros selecionados.")
+            return
+
+    df_corr_foco = df_corr_foco.nlargest(min(top_n, len(df_corr_foco)), 'Correlação Abs')
+
+    # Gráfico de barras das correlações mais fortes
+    st.subheader(f"🔝 Top {len(df_corr_foco)} Variáveis com Maior Impacto - {titulo_ano}")
+    mostrar_grafico('grafico_top_correlacoes', grafico_top_correlacoes, df_corr_foco, metrica_foco, titulo_ano,
+                    titulo_eixo)
+
+    # Análise detalhada das top 3
+    st.subheader("🔍 Análise Detalhada – Top 3 Variáveis")
+    st.info(f"🔬 Relação entre as três variáveis climáticas de maior impacto e a produtividade - {titulo_ano}")
+
+    n_pontos = int(mascara_correlacao.sum())
+    st.info(f"📊 Análise baseada em **{formatar_numero(n_pontos)} registros** ({titulo_ano})")
+
+    top3 = df_corr_foco.head(3)
+
+    for idx, row in top3.iterrows():
+        corr_fmt = str(round(row['Correlação'], 4)).replace('.', ',')
+        with st.expander(f"**{idx+1}. {row['Variável Climática']} - Decêndio {row['Decêndio']} ({row['Ano Safra']})** - Correlação: {corr_fmt}"):
+
+            col1, col2 = st.columns([2, 1])
+
             with col1:
-                metrica_mapa = st.selectbox(
-                    "Métrica para visualização:",
-                    ["Quantidade produzida (Toneladas)", 
-                     "Rendimento médio da produção (Quilogramas por Hectare)",
-                     "Área perdida (Hectares)",
-                     "Percentual de perda (%)",
-                     "Valor da produção (Mil Reais)"],
-                    key='metrica_mapa'
-                )
-            
+                df_scatter = df.loc[mascara_correlacao, [metrica_foco, 'ano', 'Município', 'Quantidade produzida (Toneladas)']]
+                df_scatter.insert(0, row['Coluna'], clima.coluna(row['Coluna'])[mascara_correlacao])
+                df_scatter = df_scatter.dropna()
+                mostrar_grafico('grafico_dispersao', grafico_dispersao,
+                                df_scatter, row['Coluna'], metrica_foco, row['Variável Climática'])
+                if metodo_correlacao != 'pearson':
+                    st.caption(f"A dispersão mostra os valores originais; a correlação ao lado é "
+                               f"{METODOS_CORRELACAO[metodo_correlacao]}.")
+                if vizinhanca != 'nenhuma':
+                    st.caption(f"A correlação ao lado usa médias na vizinhança "
+                               f"({VIZINHANCAS[vizinhanca][0].lower()}); p-valor e IC são apenas indicativos.")
+
             with col2:
-                column_width = st.slider("Largura das Colunas (metros)", 3000, 30000, 15000, 1000)
-            
-            with col3:
-                elevation_scale = st.slider("Escala de Elevação", 5, 50, 20, 5)
-            
-            # Controle de altura máxima
-            elevation_max = st.slider("Altura Máxima", 5000, 20000, 10000, 1000)
-            
-            # Preparar dados para PyDeck
-            df_mapa['metrica_viz'] = df_mapa[metrica_mapa]
-            
-            # CRIAR COLUNA FORMATADA PARA O TOOLTIP
-            # Se for percentual, usa 2 casas, se não, usa 0
-            decimais_mapa = 2 if "Percentual" in metrica_mapa else 0
-            df_mapa['metrica_viz_fmt'] = df_mapa['metrica_viz'].apply(lambda x: formatar_numero(x, decimais=decimais_mapa))
-
-            # Normalizar para cor e elevação
-            max_metrica = df_mapa['metrica_viz'].max()
-            df_mapa['elevation'] = (df_mapa['metrica_viz'] / max_metrica) * elevation_max
-            
-            # Definição do Color Range
-            COLOR_RANGE = [
-                [255, 255, 178], [254, 204, 92], [253, 141, 60],
-                [240, 59, 32], [189, 0, 38], [128, 0, 38]
-            ]
-            
-            # Função auxiliar para mapeamento de cor
-            def map_value_to_color(value, data_max, color_range, alpha=200):
-                """Mapeia um valor numérico para uma cor no COLOR_RANGE."""
-                if data_max == 0 or np.isnan(value) or value == 0:
-                    return [150, 150, 150, alpha]
-                
-                normalized_value = (value - df_mapa['metrica_viz'].min()) / (data_max - df_mapa['metrica_viz'].min())
-                
-                num_colors = len(color_range)
-                index = int(normalized_value * (num_colors - 1))
-                
-                return color_range[index] + [alpha]
-
-            # Criar a coluna de cor final no DataFrame
-            df_mapa['fill_color'] = df_mapa['metrica_viz'].apply(
-                lambda x: map_value_to_color(x, max_metrica, COLOR_RANGE)
-            )
-
-            # Criar camada de Colunas
-            column_layer = pdk.Layer(
-                "ColumnLayer",
-                data=df_mapa,
-                get_position="[lon, lat]",
-                get_elevation="elevation",
-                elevation_scale=elevation_scale,
-                radius=column_width,
-                get_fill_color="fill_color", 
-                get_tooltip=['nome', 'metrica_viz_fmt'], 
-                pickable=True,
-                auto_highlight=True,
-                extruded=True,
-            )
-            
-            # Centro do mapa
-            center_lat = df_mapa['lat'].mean()
-            center_lon = df_mapa['lon'].mean()
-            
-            # Criar visualização
-            view_state = pdk.ViewState(
-                latitude=center_lat,
-                longitude=center_lon,
-                zoom=6.5,
-                pitch=50,
-                bearing=0
-            )
-            
-            # Tooltip
-            metrica_nome_tooltip = metrica_mapa.split('(')[0].strip()
-            tooltip = {
-                "html": f"<b>Município:</b> {{nome}}<br/>"
-                        f"<b>{metrica_nome_tooltip}:</b> {{metrica_viz_fmt}}",
-                "style": {
-                    "backgroundColor": "steelblue",
-                    "color": "white"
-                }
-            }
-            
-            # Renderizar mapa
-            st.pydeck_chart(pdk.Deck(
-                layers=[column_layer],
-                initial_view_state=view_state,
-                tooltip=tooltip
-            ))
-            
-            # Legenda de Cores
-            st.subheader("🎨 Legenda de Cores")
-            
-            min_val = df_mapa['metrica_viz'].min()
-            max_val = df_mapa['metrica_viz'].max()
-            step = (max_val - min_val) / len(COLOR_RANGE)
-            
-            legend_html = f"<b>{metrica_nome_tooltip}:</b>"
-            legend_html += "<div style='display: flex; flex-direction: column;'>"
-            
-            for i, color_rgb in enumerate(COLOR_RANGE):
-                color_index = len(COLOR_RANGE) - 1 - i
-                color = COLOR_RANGE[color_index]
-                
-                lower_bound = min_val + (color_index * step)
-                upper_bound = min_val + ((color_index + 1) * step)
-                
-                css_color = f"rgb({color[0]}, {color[1]}, {color[2]})"
-                
-                # Formatação PT-BR na legenda
-                upper_bound_fmt = formatar_numero(upper_bound, decimais=2)
-                
-                legend_html += f"<div style='display: flex; align-items: center; margin-bottom: 3px;'><br/><div style='width: 20px; height: 10px; background-color: {css_color}; margin-right: 10px; border: 1px solid #333;'></div><br/><span>{upper_bound_fmt} (Máx)</span></div>"
-            
-            min_val_fmt = formatar_numero(min_val, decimais=2)
-            legend_html += f"""
-                <div style='margin-top: 5px; text-align: left;'>
-                    <span>{min_val_fmt} (Min)</span>
-                </div>
-            </div>"""
-            
-            st.markdown(legend_html, unsafe_allow_html=True)
-            
-            # Estatísticas do mapa
-            col1, col2, col3, col4 = st.columns(4)
+                st.metric("Correlação", corr_fmt)
+
+                if abs(row['Correlação']) > 0.7:
+                    intensidade = "🔴 Forte"
+                elif abs(row['Correlação']) > 0.4:
+                    intensidade = "🟡 Moderada"
+                else:
+                    intensidade = "🟢 Fraca"
+
+                st.metric("Intensidade", intensidade)
+
+                direcao = "📈 Positiva" if row['Correlação'] > 0 else "📉 Negativa"
+                st.metric("Direção", direcao)
+
+                st.metric("p-valor (FDR)", formatar_p_valor(row['p-valor FDR']),
+                          help=f"p-valor sem ajuste: {formatar_p_valor(row['p-valor'])}")
+                st.caption(f"IC 95%: [{formatar_numero(row['IC inferior'], decimais=3)}; "
+                           f"{formatar_numero(row['IC superior'], decimais=3)}] · n = {formatar_numero(row['n'])}")
+
+                st.markdown("**Interpretação:**")
+                if row['Correlação'] > 0:
+                    st.success(f"Aumento de {row['Variável Climática']} associado ao aumento de {nome_curto(metrica_foco)}")
+                else:
+                    st.warning(f"Aumento de {row['Variável Climática']} associado à redução de {nome_curto(metrica_foco)}")
+
+    # Mapa de calor: correlações por decêndio
+    st.header(f"🗺️ Mapa de Calor: Ciclo Completo da Safra - {titulo_ano}")
+
+    st.info("📅 **Ciclo da Soja:** Ano 1 (Dec 26-36: Set-Dez) → Ano 2 (Dec 1-15: Jan-Mai). "
+            "Mapa de correlações entre variáveis climáticas e produtividade ao longo das fases fenológicas.")
+
+    variaveis_disponiveis = sorted(df_corr_foco['Variável Climática'].unique())
+    vars_heatmap = st.multiselect(
+        "Selecione variáveis climáticas para o mapa de calor:",
+        options=variaveis_disponiveis,
+        default=variaveis_disponiveis[:min(5, len(variaveis_disponiveis))]
+    )
+
+    if vars_heatmap:
+        with perfil.etapa('calcular_heatmap'):
+            pivot_heatmap = heatmap_da_tabela(tabela_ano, vars_heatmap)
+
+        if len(pivot_heatmap) > 0:
+            mostrar_grafico('grafico_heatmap', grafico_heatmap, pivot_heatmap, metrica_foco, titulo_ano)
+
+            # Resumo por fase
+            st.subheader("📊 Correlação Média por Fase da Safra")
+            st.info("📋 Correlação média consolidada em cada fase fenológica.")
+            medias_fase = medias_por_fase(pivot_heatmap)
+            col1, col2 = st.columns(2)
+
             with col1:
-                st.metric("Municípios no Mapa", len(df_mapa))
+                if 'Ano1' in medias_fase:
+                    st.metric("Fase 1: Semeadura/Desenvolvimento",
+                              formatar_numero(medias_fase['Ano1'], decimais=4),
+                              help="Ano1 Dec26-36: Set-Dez")
+
             with col2:
-                st.metric(f"Média - {metrica_mapa.split('(')[0].strip()}", formatar_numero(df_mapa['metrica_viz'].mean()))
-            with col3:
-                st.metric("Máximo", formatar_numero(df_mapa['metrica_viz'].max()))
-            with col4:
-                st.metric("Mínimo", formatar_numero(df_mapa['metrica_viz'].min()))
-            
-            # Top 10 municípios no mapa
-            with st.expander("🏆 Top 10 Municípios - Visualização Detalhada"):
-                top_10_mapa = df_mapa.nlargest(10, 'metrica_viz')[['nome', metrica_mapa]].copy()
-                # Aplicar formatação visual para a tabela
-                top_10_mapa[metrica_mapa] = top_10_mapa[metrica_mapa].apply(lambda x: formatar_numero(x, decimais=2))
-                st.dataframe(top_10_mapa, hide_index=True, use_container_width=True)
-        else:
-            st.warning("⚠️ Não foi possível fazer o merge dos dados geográficos para o ano selecionado.")
-    else:
-        st.info("ℹ️ Selecione um ano disponível nos filtros para exibir o mapa.")
-else:
-    st.info("ℹ️ Mapa 3D não disponível - arquivo 'municipios.csv' não encontrado.")
+                if 'Ano2' in medias_fase:
+                    st.metric("Fase 2: Maturação/Colheita",
+                              formatar_numero(medias_fase['Ano2'], decimais=4),
+                              help="Ano2 Dec1-15: Jan-Mai")
 
-    
-# ===========================
-# GRÁFICOS PRINCIPAIS
-# ===========================
-st.header("📈Análise Produtiva")
-st.info("📈 Avaliação temporal da evolução da área cultivada, perdas percentuais e variação da produtividade.")
-
-col1, col2 = st.columns(2)
-
-with col1:
-    fig1 = go.Figure()
-    fig1.add_trace(go.Scatter(x=df_agregado['ano'], y=df_agregado['Área plantada (Hectares)'],
-                              name='Plantada', line=dict(color='#2ecc71', width=3), mode='lines+markers'))
-    fig1.add_trace(go.Scatter(x=df_agregado['ano'], y=df_agregado['Área colhida (Hectares)'],
-                              name='Colhida', line=dict(color='#27ae60', width=3), mode='lines+markers'))
-    fig1.add_trace(go.Scatter(x=df_agregado['ano'], y=df_agregado['Área perdida (Hectares)'],
-                              name='Perdida', line=dict(color='#e74c3c', width=3), fill='tozeroy', mode='lines+markers'))
-    fig1.update_layout(
-        title='<b>Evolução da Área e Perdas</b>', 
-        xaxis_title='Ano', yaxis_title='Hectares', hovermode='x unified', height=450,
-        font=dict(color='black'),
-        separators=',.'  # CONFIGURAÇÃO PT-BR
-    )
-    fig1.update_xaxes(type='category', tickfont=dict(color='black'), title_font=dict(color='black')) 
-    fig1.update_yaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-    st.plotly_chart(fig1, use_container_width=True)
-
-with col2:
-    fig2 = make_subplots(specs=[[{"secondary_y": True}]])
-    fig2.add_trace(go.Bar(x=df_agregado['ano'], y=df_agregado['Quantidade produzida (Toneladas)'],
-                          name='Produção', marker_color='#3498db'), secondary_y=False)
-    fig2.add_trace(go.Scatter(x=df_agregado['ano'], y=df_agregado['Percentual de perda (%)'],
-                              name='% Perda', line=dict(color='#e74c3c', width=3), mode='lines+markers'), secondary_y=True)
-    fig2.update_layout(
-        title='<b>Produção e Percentual de Perda</b>', hovermode='x unified', height=450,
-        font=dict(color='black'),
-        separators=',.' # CONFIGURAÇÃO PT-BR
-    )
-    fig2.update_xaxes(title_text="Ano", type='category', tickfont=dict(color='black'), title_font=dict(color='black')) 
-    fig2.update_yaxes(title_text="Quilograma", secondary_y=False, tickfont=dict(color='black'), title_font=dict(color='black'))
-    fig2.update_yaxes(title_text="% Perda", secondary_y=True, tickfont=dict(color='black'), title_font=dict(color='black'))
-    st.plotly_chart(fig2, use_container_width=True)
-
-col1, col2 = st.columns(2)
-
-with col1:
-    fig3 = go.Figure()
-    fig3.add_trace(go.Scatter(x=df_agregado['ano'], y=df_agregado['Rendimento médio da produção (Quilogramas por Hectare)'],
-                              mode='lines+markers', line=dict(color='#9b59b6', width=3), marker=dict(size=12)))
-    fig3.update_layout(
-        title='<b>Rendimento Médio</b>', xaxis_title='Ano', yaxis_title='kg/ha', height=400,
-        font=dict(color='black'),
-        separators=',.' # CONFIGURAÇÃO PT-BR
-    )
-    fig3.update_xaxes(type='category', tickfont=dict(color='black'), title_font=dict(color='black')) 
-    fig3.update_yaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-    st.plotly_chart(fig3, use_container_width=True)
-
-with col2:
-    # Formatando o texto das barras manualmente para R$ com vírgula
-    texto_valor = df_agregado['Valor da produção (Mil Reais)'].apply(lambda x: f"R$ {formatar_numero(x)}")
-    
-    fig4 = go.Figure()
-    fig4.add_trace(go.Bar(
-        x=df_agregado['ano'], 
-        y=df_agregado['Valor da produção (Mil Reais)'],
-        marker_color='#16a085', 
-        text=texto_valor,
-        textposition='outside'
-    ))
-    fig4.update_layout(
-        title='<b>Valor da Produção</b>', 
-        xaxis_title='Ano', 
-        yaxis_title='Reais (R$)', 
-        height=400,
-        yaxis=dict(range=[0, df_agregado['Valor da produção (Mil Reais)'].max() * 1.15]),
-        font=dict(color='black'),
-        separators=',.' # CONFIGURAÇÃO PT-BR
-    )
-    fig4.update_xaxes(type='category', tickfont=dict(color='black'), title_font=dict(color='black')) 
-    fig4.update_yaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-    st.plotly_chart(fig4, use_container_width=True)
 
-# ===========================
-# NOVA SEÇÃO: MATRIZ DE CORRELAÇÃO
-# ===========================
-st.header("🔗 Matriz de Correlação (Variáveis de Produção)")
-st.info("📊 Correlação de Pearson entre as variáveis de área, produção, rendimento e valor.")
-
-# Definindo as colunas para correlação
-cols_correlacao = [
-    'Área plantada (Hectares)',
-    'Área colhida (Hectares)',
-    'Área perdida (Hectares)',
-    'Quantidade produzida (Toneladas)',
-    'Rendimento médio da produção (Quilogramas por Hectare)',
-    'Valor da produção (Mil Reais)',
-    'Valor da produção - percentual do total geral',
-    'Percentual de perda (%)'
-]
-
-# Verificar quais colunas realmente existem no DataFrame atual para evitar erros
-cols_validas = [col for col in cols_correlacao if col in df_filtrado.columns]
-
-if len(cols_validas) > 1:
-    corr_matrix = df_filtrado[cols_validas].corr()
-    
-    # Criar uma matriz de texto com formatação PT-BR para o Heatmap
-    text_matrix = corr_matrix.applymap(lambda x: f"{str(round(x, 2)).replace('.', ',')}")
-
-    fig_corr = px.imshow(
-        corr_matrix,
-        text_auto=False, # Desliga automático para usar nossa matriz formatada
-        aspect="auto",
-        color_continuous_scale='RdYlGn',
-        zmin=-1, zmax=1,
-        height=600
-    )
-    
-    # Adicionar o texto manualmente
-    fig_corr.update_traces(text=text_matrix, texttemplate="%{text}")
-    
-    fig_corr.update_layout(
-        title='<b>Matriz de Correlação de Pearson</b>', 
-        font=dict(color='black'),
-        separators=',.'
-    )
-    fig_corr.update_xaxes(tickfont=dict(color='black'))
-    fig_corr.update_yaxes(tickfont=dict(color='black'))
-    st.plotly_chart(fig_corr, use_container_width=True)
-else:
-    st.warning("Colunas insuficientes encontradas no arquivo para gerar a matriz de correlação completa.")
+# RANKING DE MUNICÍPIOS - EVOLUÇÃO ANUAL
+@st.fragment
+def secao_municipios(cubo_filtrado):
+    st.header("🏘️ Evolução dos Top Municípios")
+    st.info("📋 Acompanhamento da evolução anual dos principais municípios produtores de soja no Paraná.")
 
-# ===========================
-# VARIÁVEIS CLIMÁTICAS MAIS RELEVANTES
-# ===========================
-st.header("🌤️ Variáveis Climáticas Mais Relevantes")
-
-st.info("📋 **Análise automática:** Identificando as variáveis climáticas com maior correlação com rendimento, produção e perdas.")
-
-# Filtros principais
-col1, col2, col3 = st.columns(3)
-
-with col1:
-    top_n = st.slider("Número de variáveis mais relevantes:", 5, 20, 10)
-
-with col2:
-    metrica_foco = st.selectbox("Foco da análise:", [
-        'Rendimento médio da produção (Quilogramas por Hectare)',
-        'Quantidade produzida (Toneladas)',
-        'Área perdida (Hectares)',
-        'Percentual de perda (%)',
-        'Valor da produção (Mil Reais)'
-    ])
-
-with col3:
-    ano_clima_analise = st.selectbox(
-        "Ano para análise:",
-        options=["Todos os anos"] + [str(ano) for ano in sorted(anos_selecionados)],
-        index=0
-    )
+    # Seleção de número de municípios
+    num_municipios = st.slider("Número de municípios no ranking:", 3, 15, 5)
 
-# Filtrar dados por ano se necessário
-if ano_clima_analise == "Todos os anos":
-    df_para_correlacao = df_filtrado.copy()
-    titulo_ano = "Todos os Anos"
-else:
-    df_para_correlacao = df_filtrado[df_filtrado['ano'] == int(ano_clima_analise)].copy()
-    titulo_ano = ano_clima_analise
+    # Identificar top municípios baseado na média de todos os anos filtrados
+    medias_municipios = media_por_municipio(cubo_filtrado, MEDIDAS_RANKING)
 
-# Recalcular correlações com o filtro de ano
-@st.cache_data
-def calcular_correlacoes_por_ano(_df, metrica, ano_filtro):
-    resultados = []
-    
-    for col_clima in colunas_climaticas:
-        try:
-            df_temp = _df[[col_clima, metrica]].dropna()
-            if len(df_temp) > 5:
-                corr = df_temp.corr().iloc[0, 1]
-                if not np.isnan(corr):
-                    atributo = col_clima.rsplit('_dec', 1)[0]
-                    dec_match = re.search(r'dec(\d+)', col_clima)
-                    ano_match = re.search(r'ano(\d+)', col_clima)
-                    
-                    if dec_match and ano_match:
-                        resultados.append({
-                            'Variável Climática': atributo,
-                            'Decêndio': int(dec_match.group(1)),
-                            'Ano Safra': f"ano{ano_match.group(1)}",
-                            'Coluna': col_clima,
-                            'Correlação': corr,
-                            'Correlação Abs': abs(corr)
-                        })
-        except:
-            continue
-    
-    return pd.DataFrame(resultados)
-
-df_corr_foco = calcular_correlacoes_por_ano(df_para_correlacao, metrica_foco, ano_clima_analise)
-
-if len(df_corr_foco) == 0:
-    st.warning("⚠️ Não há dados suficientes para calcular correlações com os filtros selecionados.")
-    st.stop()
-
-df_corr_foco = df_corr_foco.nlargest(min(top_n, len(df_corr_foco)), 'Correlação Abs')
-
-# Gráfico de barras das correlações mais fortes
-st.subheader(f"🔝 Top {len(df_corr_foco)} Variáveis com Maior Impacto - {titulo_ano}")
-
-# Formatando texto para o gráfico de barras
-texto_corr = df_corr_foco['Correlação'].apply(lambda x: f"{x:.3f}".replace('.', ','))
-
-fig_top = go.Figure()
-fig_top.add_trace(go.Bar(
-    x=df_corr_foco['Correlação'],
-    y=[f"{row['Variável Climática']}_dec{row['Decêndio']}_{row['Ano Safra']}" for _, row in df_corr_foco.iterrows()],
-    orientation='h',
-    marker_color=df_corr_foco['Correlação'],
-    marker_colorscale='RdYlGn',
-    marker_cmin=-1,
-    marker_cmax=1,
-    text=texto_corr,
-    textposition='outside'
-))
-
-fig_top.update_layout(
-    title=f'<b>Correlação com: {metrica_foco} ({titulo_ano})</b>',
-    xaxis_title='Correlação de Pearson',
-    yaxis_title='Variável Climática',
-    height=max(400, len(df_corr_foco) * 30),
-    xaxis_range=[-1, 1],
-    font=dict(color='black'),
-    separators=',.' # CONFIGURAÇÃO PT-BR
-)
-fig_top.update_xaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-fig_top.update_yaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-fig_top.add_vline(x=0, line_dash="dash", line_color="#000000")
-st.plotly_chart(fig_top, use_container_width=True)
-
-# Análise detalhada das top 3
-st.subheader("🔍 Análise Detalhada – Top 3 Variáveis")
-st.info(f"🔬 Relação entre as três variáveis climáticas de maior impacto e a produtividade - {titulo_ano}")
-
-n_pontos = len(df_para_correlacao)
-st.info(f"📊 Análise baseada em **{formatar_numero(n_pontos)} registros** ({titulo_ano})")
-
-top3 = df_corr_foco.head(3)
-
-for idx, row in top3.iterrows():
-    corr_fmt = str(round(row['Correlação'], 4)).replace('.', ',')
-    with st.expander(f"**{idx+1}. {row['Variável Climática']} - Decêndio {row['Decêndio']} ({row['Ano Safra']})** - Correlação: {corr_fmt}"):
-        
-        col1, col2 = st.columns([2, 1])
-        
-        with col1:
-            df_scatter = df_para_correlacao[[row['Coluna'], metrica_foco, 'ano', 'Município', 'Quantidade produzida (Toneladas)']].dropna()
-            
-            # Título do gráfico
-            titulo_scatter = f"Dispersão ({metrica_foco.split('(')[0].strip()}) × ({row['Variável Climática']})"
-            
-            try:
-                fig_scatter = px.scatter(
-                    df_scatter,
-                    x=row['Coluna'],
-                    y=metrica_foco,
-                    color='ano',
-                    size='Quantidade produzida (Toneladas)',
-                    hover_data=['Município'],
-                    trendline='ols',
-                    title=titulo_scatter
-                )
-            except:
-                fig_scatter = px.scatter(
-                    df_scatter,
-                    x=row['Coluna'],
-                    y=metrica_foco,
-                    color='ano',
-                    size='Quantidade produzida (Toneladas)',
-                    hover_data=['Município'],
-                    title=titulo_scatter
-                )
-                
-                if len(df_scatter) > 1:
-                    slope, intercept, r_value, p_value, std_err = stats.linregress(df_scatter[row['Coluna']], df_scatter[metrica_foco])
-                    line_x = np.array([df_scatter[row['Coluna']].min(), df_scatter[row['Coluna']].max()])
-                    line_y = slope * line_x + intercept
-                    
-                    fig_scatter.add_trace(go.Scatter(
-                        x=line_x,
-                        y=line_y,
-                        mode='lines',
-                        name='Tendência',
-                        line=dict(color='red', dash='dash', width=2)
-                    ))
-            
-            fig_scatter.update_layout(
-                height=400, 
-                font=dict(color='black'),
-                separators=',.' # CONFIGURAÇÃO PT-BR
-            )
-            fig_scatter.update_xaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-            fig_scatter.update_yaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-            st.plotly_chart(fig_scatter, use_container_width=True)
-        
-        with col2:
-            st.metric("Correlação", corr_fmt)
-            
-            if abs(row['Correlação']) > 0.7:
-                intensidade = "🔴 Forte"
-            elif abs(row['Correlação']) > 0.4:
-                intensidade = "🟡 Moderada"
-            else:
-                intensidade = "🟢 Fraca"
-            
-            st.metric("Intensidade", intensidade)
-            
-            direcao = "📈 Positiva" if row['Correlação'] > 0 else "📉 Negativa"
-            st.metric("Direção", direcao)
-            
-            st.markdown("**Interpretação:**")
-            if row['Correlação'] > 0:
-                st.success(f"Aumento de {row['Variável Climática']} associado ao aumento de {metrica_foco.split('(')[0].strip()}")
-            else:
-                st.warning(f"Aumento de {row['Variável Climática']} associado à redução de {metrica_foco.split('(')[0].strip()}")
+    def top_municipios(medida):
+        return medias_municipios[medida].nlargest(num_municipios).index
 
-# ===========================
-# MAPA DE CALOR: Correlações por Decêndio
-# ===========================
-st.header(f"🗺️ Mapa de Calor: Ciclo Completo da Safra - {titulo_ano}")
+    # Evolução ano × município das quatro medidas, em uma única passada sobre o cubo
+    evolucao_municipios = evolucao_por_municipio(cubo_filtrado, MEDIDAS_RANKING)
 
-st.info("📅 **Ciclo da Soja:** Ano 1 (Dec 26-36: Set-Dez) → Ano 2 (Dec 1-15: Jan-Mai). "
-        "Mapa de correlações entre variáveis climáticas e produtividade ao longo das fases fenológicas.")
+    col1, col2 = st.columns(2)
 
-variaveis_disponiveis = sorted(df_corr_foco['Variável Climática'].unique())
-vars_heatmap = st.multiselect(
-    "Selecione variáveis climáticas para o mapa de calor:",
-    options=variaveis_disponiveis,
-    default=variaveis_disponiveis[:min(5, len(variaveis_disponiveis))]
-)
+    with col1:
+        # Evolução da Produção Total (toneladas × 1000 → Kg)
+        mostrar_grafico(
+            'evolucao_producao', grafico_evolucao_municipios,
+            evolucao_municipios, 'Quantidade produzida (Toneladas)',
+            top_municipios('Quantidade produzida (Toneladas)'),
+            f'<b>Top {num_municipios} – Evolução da Produção Total</b>', 'Produção (Kg)', fator=1000
+        )
 
-if vars_heatmap:
-    decendios_ano1 = list(range(26, 37))
-    decendios_ano2 = list(range(1, 16))
-    
-    heatmap_data = []
-    
-    for var_clima in vars_heatmap:
-        # Ano 1: decêndios 26-36
-        for dec_num in decendios_ano1:
-            col_name = f"{var_clima}_dec{dec_num}_ano1"
-            if col_name in df_para_correlacao.columns:
-                try:
-                    df_temp = df_para_correlacao[[col_name, metrica_foco]].dropna()
-                    if len(df_temp) > 5:
-                        corr = df_temp.corr().iloc[0, 1]
-                        if not np.isnan(corr):
-                            heatmap_data.append({
-                                'Variável': var_clima,
-                                'Período': f"Ano1_Dec{dec_num}",
-                                'Decêndio_Order': dec_num - 26,
-                                'Correlação': corr
-                            })
-                except:
-                    pass
-        
-        # Ano 2: decêndios 1-15
-        for dec_num in decendios_ano2:
-            col_name = f"{var_clima}_dec{dec_num}_ano2"
-            if col_name in df_para_correlacao.columns:
-                try:
-                    df_temp = df_para_correlacao[[col_name, metrica_foco]].dropna()
-                    if len(df_temp) > 5:
-                        corr = df_temp.corr().iloc[0, 1]
-                        if not np.isnan(corr):
-                            heatmap_data.append({
-                                'Variável': var_clima,
-                                'Período': f"Ano2_Dec{dec_num}",
-                                'Decêndio_Order': 11 + (dec_num - 1),
-                                'Correlação': corr
-                            })
-                except:
-                    pass
-    
-    df_heatmap = pd.DataFrame(heatmap_data)
-    
-    if len(df_heatmap) > 0:
-        pivot_heatmap = df_heatmap.pivot_table(
-            values='Correlação',
-            index='Variável',
-            columns='Período',
-            aggfunc='first'
+    with col2:
+        # Evolução da Produtividade Média
+        mostrar_grafico(
+            'evolucao_produtividade', grafico_evolucao_municipios,
+            evolucao_municipios, 'Rendimento médio da produção (Quilogramas por Hectare)',
+            top_municipios('Rendimento médio da produção (Quilogramas por Hectare)'),
+            f'<b>Top {num_municipios} – Evolução da Produtividade</b>', 'Rendimento (kg/ha)'
         )
-        
-        colunas_ordenadas = [f"Ano1_Dec{i}" for i in decendios_ano1] + [f"Ano2_Dec{i}" for i in decendios_ano2]
-        colunas_presentes = [col for col in colunas_ordenadas if col in pivot_heatmap.columns]
-        pivot_heatmap = pivot_heatmap[colunas_presentes]
-        
-        # Criar textos formatados para o heatmap
-        text_heatmap = pivot_heatmap.applymap(lambda x: f"{x:.2f}".replace('.', ','))
-
-        fig_heatmap = go.Figure(data=go.Heatmap(
-            z=pivot_heatmap.values,
-            x=pivot_heatmap.columns,
-            y=pivot_heatmap.index,
-            colorscale='RdYlGn',
-            zmid=0,
-            text=text_heatmap.values,
-            texttemplate='%{text}',
-            textfont={"size": 8},
-            colorbar=dict(title="Correlação"),
-            zmin=-1,
-            zmax=1
-        ))
-        
-        fig_heatmap.update_layout(
-            title=f'<b>Correlação ao longo do Ciclo da Safra: {metrica_foco.split("(")[0].strip()} ({titulo_ano})</b>',
-            xaxis_title='Período (Ano1: Set-Dez | Ano2: Jan-Mai)',
-            yaxis_title='Variável Climática',
-            height=max(500, len(pivot_heatmap) * 70),
-            xaxis=dict(
-                tickangle=-45,
-                tickfont=dict(size=9, color='black'),
-                title_font=dict(color='black')
-            ),
-            yaxis=dict(
-                tickfont=dict(color='black'),
-                title_font=dict(color='black')
-            ),
-            font=dict(color='black'),
-            separators=',.'
+
+    col3, col4 = st.columns(2)
+
+    with col3:
+        # Evolução da Área Plantada
+        mostrar_grafico(
+            'evolucao_area', grafico_evolucao_municipios,
+            evolucao_municipios, 'Área plantada (Hectares)',
+            top_municipios('Área plantada (Hectares)'),
+            f'<b>Top {num_municipios} – Evolução da Área Plantada</b>', 'Área Plantada (ha)'
         )
-        
-        fig_heatmap.add_vline(x=10.5, line_dash="dash", line_color="white", line_width=2)
-        
-        st.plotly_chart(fig_heatmap, use_container_width=True)
-        
-        # Resumo por fase
-        st.subheader("📊 Correlação Média por Fase da Safra")
-        st.info("📋 Correlação média consolidada em cada fase fenológica.")
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            ano1_cols = [col for col in pivot_heatmap.columns if col.startswith("Ano1")]
-            if ano1_cols:
-                ano1_data = pivot_heatmap[ano1_cols]
-                val = ano1_data.mean().mean()
-                st.metric("Fase 1: Semeadura/Desenvolvimento", 
-                          formatar_numero(val, decimais=4),
-                          help="Ano1 Dec26-36: Set-Dez")
-        
-        with col2:
-            ano2_cols = [col for col in pivot_heatmap.columns if col.startswith("Ano2")]
-            if ano2_cols:
-                ano2_data = pivot_heatmap[ano2_cols]
-                val = ano2_data.mean().mean()
-                st.metric("Fase 2: Maturação/Colheita", 
-                          formatar_numero(val, decimais=4),
-                          help="Ano2 Dec1-15: Jan-Mai")
+
+    with col4:
+        # Evolução do Valor da produção
+        mostrar_grafico(
+            'evolucao_valor', grafico_evolucao_municipios,
+            evolucao_municipios, 'Valor da produção (Mil Reais)',
+            top_municipios('Valor da produção (Mil Reais)'),
+            f'<b>Top {num_municipios} – Valor da produção</b>', 'Valor da produção (R$)'
+        )
+
+
+aba_mapa, aba_producao, aba_clima, aba_municipios = st.tabs(
+    ["🗺️ Mapa 3D", "📈 Análise Produtiva", "🌤️ Clima", "🏘️ Municípios"],
+    key='aba_secao',
+    on_change='rerun'
+)
+
+with aba_mapa:
+    if aba_mapa.open:
+        secao_mapa(mascara_filtro, cubo_filtrado)
+
+with aba_producao:
+    if aba_producao.open:
+        secao_producao(df_agregado, mascara_filtro)
+
+with aba_clima:
+    if aba_clima.open:
+        secao_clima(mascara_filtro, chave_filtro, anos_selecionados)
+
+with aba_municipios:
+    if aba_municipios.open:
+        secao_municipios(cubo_filtrado)
 
 # ===========================
-# RANKING DE MUNICÍPIOS - EVOLUÇÃO ANUAL
+# PAINEL DE DESEMPENHO
 # ===========================
-st.header("🏘️ Evolução dos Top Municípios")
-st.info("📋 Acompanhamento da evolução anual dos principais municípios produtores de soja no Paraná.")
-
-# Seleção de número de municípios
-num_municipios = st.slider("Número de municípios no ranking:", 3, 15, 5)
-
-# Identificar top municípios baseado na média de todos os anos filtrados
-top_prod_municipios = df_filtrado.groupby('Município')['Quantidade produzida (Toneladas)'].mean().nlargest(num_municipios).index
-top_rend_municipios = df_filtrado.groupby('Município')['Rendimento médio da produção (Quilogramas por Hectare)'].mean().nlargest(num_municipios).index
-top_area_municipios = df_filtrado.groupby('Município')['Área plantada (Hectares)'].mean().nlargest(num_municipios).index
-top_valor_municipios = df_filtrado.groupby('Município')['Valor da produção (Mil Reais)'].mean().nlargest(num_municipios).index
-
-
-col1, col2 = st.columns(2)
-
-with col1:
-    # Evolução da Produção Total
-    df_prod_top = df_filtrado[df_filtrado['Município'].isin(top_prod_municipios)].copy()
-    
-    fig_p = go.Figure()
-    for municipio in top_prod_municipios:
-        df_mun = df_prod_top[df_prod_top['Município'] == municipio].sort_values('ano')
-        fig_p.add_trace(go.Scatter(
-            x=df_mun['ano'],
-            y=df_mun['Quantidade produzida (Toneladas)'] * 1000,  # Converter para Quilogramas (mas se o título diz Kg, ok)
-            # Se o dado original já é toneladas, * 1000 vira Kg.
-            mode='lines+markers',
-            name=municipio,
-            line=dict(width=2),
-            marker=dict(size=8)
-        ))
-    
-    fig_p.update_layout(
-        title=f'<b>Top {num_municipios} – Evolução da Produção Total</b>',
-        xaxis_title='Ano',
-        yaxis_title='Produção (Kg)',
-        height=500,
-        hovermode='x unified',
-        legend=dict(orientation="v", yanchor="top", y=1, xanchor="left", x=1.02),
-        font=dict(color='black'),
-        separators=',.' # CONFIGURAÇÃO PT-BR
-    )
-    fig_p.update_xaxes(type='linear', tickfont=dict(color='black'), title_font=dict(color='black')) 
-    fig_p.update_yaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-    st.plotly_chart(fig_p, use_container_width=True)
-
-with col2:
-    # Evolução da Produtividade Média
-    df_rend_top = df_filtrado[df_filtrado['Município'].isin(top_rend_municipios)].copy()
-    
-    fig_r = go.Figure()
-    for municipio in top_rend_municipios:
-        df_mun = df_rend_top[df_rend_top['Município'] == municipio].sort_values('ano')
-        fig_r.add_trace(go.Scatter(
-            x=df_mun['ano'],
-            y=df_mun['Rendimento médio da produção (Quilogramas por Hectare)'],
-            mode='lines+markers',
-            name=municipio,
-            line=dict(width=2),
-            marker=dict(size=8)
-        ))
-    
-    fig_r.update_layout(
-        title=f'<b>Top {num_municipios} – Evolução da Produtividade</b>',
-        xaxis_title='Ano',
-        yaxis_title='Rendimento (kg/ha)',
-        height=500,
-        hovermode='x unified',
-        legend=dict(orientation="v", yanchor="top", y=1, xanchor="left", x=1.02),
-        font=dict(color='black'),
-        separators=',.' # CONFIGURAÇÃO PT-BR
-    )
-    fig_r.update_xaxes(type='linear', tickfont=dict(color='black'), title_font=dict(color='black')) 
-    fig_r.update_yaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-    st.plotly_chart(fig_r, use_container_width=True)
-
-col3, col4 = st.columns(2)
-
-with col3:
-    # Evolução da Área Plantada
-    df_area_top = df_filtrado[df_filtrado['Município'].isin(top_area_municipios)].copy()
-    
-    fig_a = go.Figure()
-    for municipio in top_area_municipios:
-        df_mun = df_area_top[df_area_top['Município'] == municipio].sort_values('ano')
-        fig_a.add_trace(go.Scatter(
-            x=df_mun['ano'],
-            y=df_mun['Área plantada (Hectares)'],
-            mode='lines+markers',
-            name=municipio,
-            line=dict(width=2),
-            marker=dict(size=8)
-        ))
-    
-    fig_a.update_layout(
-        title=f'<b>Top {num_municipios} – Evolução da Área Plantada</b>',
-        xaxis_title='Ano',
-        yaxis_title='Área Plantada (ha)',
-        height=500,
-        hovermode='x unified',
-        legend=dict(orientation="v", yanchor="top", y=1, xanchor="left", x=1.02),
-        font=dict(color='black'),
-        separators=',.' # CONFIGURAÇÃO PT-BR
-    )
-    fig_a.update_xaxes(type='linear', tickfont=dict(color='black'), title_font=dict(color='black')) 
-    fig_a.update_yaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-    st.plotly_chart(fig_a, use_container_width=True)
-
-with col4:
-    # Evolução do Valor da produção
-    df_valor_top = df_filtrado[df_filtrado['Município'].isin(top_valor_municipios)].copy()
-    
-    fig_v = go.Figure()
-    for municipio in top_valor_municipios:
-        df_mun = df_valor_top[df_valor_top['Município'] == municipio].sort_values('ano')
-        fig_v.add_trace(go.Scatter(
-            x=df_mun['ano'],
-            y=df_mun['Valor da produção (Mil Reais)'],
-            mode='lines+markers',
-            name=municipio,
-            line=dict(width=2),
-            marker=dict(size=8)
-        ))
-    
-    fig_v.update_layout(
-        title=f'<b>Top {num_municipios} – Valor da produção</b>',
-        xaxis_title='Ano',
-        yaxis_title='Valor da produção (R$)',
-        height=500,
-        hovermode='x unified',
-        legend=dict(orientation="v", yanchor="top", y=1, xanchor="left", x=1.02),
-        font=dict(color='black'),
-        separators=',.' # CONFIGURAÇÃO PT-BR
-    )
-    fig_v.update_xaxes(type='linear', tickfont=dict(color='black'), title_font=dict(color='black')) 
-    fig_v.update_yaxes(tickfont=dict(color='black'), title_font=dict(color='black'))
-    st.plotly_chart(fig_v, use_container_width=True)
+if painel_desempenho:
+    with st.sidebar.expander("⏱️ Desempenho da sessão", expanded=True):
+        st.caption(f"Execução {perfil.execucao} (as reexecuções de uma seção isolada aparecem na próxima execução completa)")
+        ultima = perfil.tabela(perfil.execucao)
+        st.dataframe(
+            ultima[['etapa', 'duracao_ms', 'cache', 'bytes']].round({'duracao_ms': 1}),
+            hide_index=True, use_container_width=True
+        )
+        residentes = clima.residentes()
+        st.caption(f"Atributos climáticos em memória: {len(residentes)}/{clima.max_blocos} "
+                   f"({', '.join(residentes) or '-'}) · leituras do cache: {clima.leituras}")
+        st.markdown("**Acumulado da sessão**")
+        st.dataframe(perfil.resumo().round(1), hide_index=True, use_container_width=True)
+        st.download_button(
+            "📥 Exportar (JSON lines)",
+            perfil.jsonl(),
+            file_name='perfil_dashboard.jsonl',
+            mime='application/jsonl'
+        )
 
 # Rodapé
 st.markdown("---")
 st.markdown("""
     <div style='text-align: center; color: #683;'>
-        🌱 <b>Dashboard Inteligente - Soja Paraná</b> | 
+        🌱 <b>Dashboard Inteligente - Soja Paraná</b> |
         Fonte: PAM/SIDRA + NASA POWER | Desenvolvido por: Bruno Proença
     </div>
-""", unsafe_allow_html=True)
\ No newline at end of file
+""", unsafe_allow_html=True)